@@ -0,0 +1,276 @@
+import numpy as np
+from StarStore import MaskCache
+
+
+class SlidingBackground:
+    """Background statistics of an annulus around a fixed centre, updated ring by ring when the radii change"""
+
+    def __init__(self, image: np.ndarray, cx, cy, max_radius):
+        shape = image.shape
+        y_lo, y_hi = max(int(np.floor(cy - max_radius)), 0), min(int(np.ceil(cy + max_radius)) + 1, shape[0])
+        x_lo, x_hi = max(int(np.floor(cx - max_radius)), 0), min(int(np.ceil(cx + max_radius)) + 1, shape[1])
+
+        y, x = np.ogrid[y_lo:y_hi, x_lo:x_hi]
+        distance = np.sqrt((x - cx) ** 2 + (y - cy) ** 2).ravel()
+        order = np.argsort(distance, kind='stable')
+        self.distance = distance[order]
+        self.values = image[y_lo:y_hi, x_lo:x_hi].ravel()[order]
+        self.cumulative = np.concatenate(([0], np.cumsum(self.values)))
+
+        # order statistics live on the value ranks of the pixels
+        value_order = np.argsort(self.values, kind='stable')
+        self.sorted_values = self.values[value_order]
+        self.rank = np.empty_like(value_order)
+        self.rank[value_order] = np.arange(self.values.size)
+
+        # sums are taken relative to a reference value to keep the variance well conditioned
+        self.reference = self.sorted_values[self.values.size // 2] if self.values.size else 0.0
+        shifted = self.values - self.reference
+        self._moments = np.array([np.ones_like(shifted), shifted, shifted ** 2])
+        self._tree = np.zeros((3, self.values.size + 1))
+        self.lo = 0
+        self.hi = 0
+
+    def aperture_sum(self, hole, radius):
+        lo, hi = self._bounds(hole, radius)
+        return self.cumulative[hi] - self.cumulative[lo], hi - lo
+
+    def set_annulus(self, hole, radius):
+        lo, hi = self._bounds(hole, radius)
+
+        self._update(self.lo, min(lo, self.hi), -1)
+        self._update(max(hi, self.lo), self.hi, -1)
+        self._update(lo, min(self.lo, hi), 1)
+        self._update(max(self.hi, lo), hi, 1)
+
+        self.lo, self.hi = lo, hi
+
+    def median(self):
+        count = self.hi - self.lo
+        if count == 0:
+            return np.nan
+
+        return 0.5 * (self._kth((count - 1) // 2) + self._kth(count // 2))
+
+    def clipped_median(self, low=4.0, high=4.0):
+        """median after scipy.stats.sigmaclip of the current annulus"""
+        rank_lo, rank_hi = 0, self.values.size
+        count, total, squares = self._prefix(rank_hi) - self._prefix(rank_lo)
+        if count == 0:
+            return np.nan
+
+        while True:
+            mean = total / count
+            std = np.sqrt(max(squares / count - mean ** 2, 0))
+            rank_lo = max(rank_lo, np.searchsorted(self.sorted_values, self.reference + mean - std * low, 'left'))
+            rank_hi = min(rank_hi, np.searchsorted(self.sorted_values, self.reference + mean + std * high, 'right'))
+
+            size = count
+            count, total, squares = self._prefix(rank_hi) - self._prefix(rank_lo)
+            if count == size or count == 0:
+                break
+
+        if count == 0:
+            return np.nan
+
+        offset = int(self._prefix(rank_lo)[0])
+        count = int(count)
+        return 0.5 * (self._kth(offset + (count - 1) // 2) + self._kth(offset + count // 2))
+
+    def _bounds(self, hole, radius):
+        lo = np.searchsorted(self.distance, hole, side='left')
+        hi = np.searchsorted(self.distance, radius, side='left')
+        return lo, max(lo, hi)
+
+    def _update(self, start, stop, sign):
+        if stop <= start:
+            return
+
+        index = self.rank[start:stop] + 1
+        delta = sign * self._moments[:, start:stop]
+        size = self.values.size
+        while index.size:
+            np.add.at(self._tree, (slice(None), index), delta)
+            index = index + (index & -index)
+            keep = index <= size
+            index, delta = index[keep], delta[:, keep]
+
+    def _prefix(self, k):
+        total = np.zeros(3)
+        while k > 0:
+            total += self._tree[:, k]
+            k -= k & -k
+        return total
+
+    def _kth(self, k):
+        """value of the k-th smallest active pixel (0-based)"""
+        position = 0
+        step = 1 << int(self.values.size).bit_length()
+        counts = self._tree[0]
+        while step:
+            candidate = position + step
+            if candidate <= self.values.size and counts[candidate] <= k:
+                position = candidate
+                k -= counts[candidate]
+            step >>= 1
+        return self.sorted_values[position]
+
+
+def sigmaclip_median(stack: np.ndarray, mask: np.ndarray = None, low=4.0, high=4.0):
+    """Median after scipy.stats.sigmaclip along the last axis of a stack of samples, all clipped together.
+
+    mask marks the valid entries of each sample (for stacks of annuli of different size).
+    Returns the medians and the number of clipping iterations each sample needed.
+    """
+    stack = np.asarray(stack, dtype=float)
+    if mask is None:
+        size = np.full(stack.shape[:-1], stack.shape[-1])
+    else:
+        size = np.sum(mask, axis=-1)
+        stack = np.where(mask, stack, np.inf)
+
+    # every clipped sample is a window [lo, hi) of the sorted sample, moments come from prefix sums
+    ordered = np.sort(stack, axis=-1)
+    reference = np.where(size > 0, _take(ordered, np.maximum(size - 1, 0) // 2), 0.0)
+    # masked entries sort to the end as inf and never enter a window
+    shifted = ordered - reference[..., None]
+    zeros = np.zeros(stack.shape[:-1] + (1,))
+    sums = np.concatenate((zeros, np.cumsum(shifted, axis=-1)), axis=-1)
+    squares = np.concatenate((zeros, np.cumsum(shifted ** 2, axis=-1)), axis=-1)
+
+    lo = np.zeros_like(size)
+    hi = size.copy()
+    iterations = np.ones_like(size)
+    active = size > 0
+    while np.any(active):
+        count = np.maximum(hi - lo, 1)
+        mean = (_take(sums, hi) - _take(sums, lo)) / count
+        std = np.sqrt(np.maximum((_take(squares, hi) - _take(squares, lo)) / count - mean ** 2, 0))
+
+        new_lo = np.maximum(lo, _search(ordered, reference + mean - std * low, size, 'left'))
+        new_hi = np.minimum(hi, _search(ordered, reference + mean + std * high, size, 'right'))
+        active &= (new_hi - new_lo) != (hi - lo)
+        lo, hi = np.where(active, new_lo, lo), np.where(active, new_hi, hi)
+        iterations += active
+
+    count = hi - lo
+    lower = _take(ordered, np.minimum(lo + np.maximum(count - 1, 0) // 2, stack.shape[-1] - 1))
+    upper = _take(ordered, np.minimum(lo + count // 2, stack.shape[-1] - 1))
+    medians = np.where(count > 0, 0.5 * (lower + upper), np.nan)
+    return medians, iterations
+
+
+def _take(array, index):
+    return np.take_along_axis(array, index[..., None], axis=-1)[..., 0]
+
+
+def _search(ordered, target, size, side):
+    """np.searchsorted on each sample of a sorted stack, restricted to its first size entries"""
+    lo = np.zeros_like(size)
+    hi = size.copy()
+    while np.any(lo < hi):
+        searching = lo < hi
+        mid = (lo + hi) // 2
+        value = _take(ordered, np.minimum(mid, ordered.shape[-1] - 1))
+        right = (value < target) if side == 'left' else (value <= target)
+        lo = np.where(searching & right, mid + 1, lo)
+        hi = np.where(searching & ~right, mid, hi)
+    return lo
+
+
+design_cache = MaskCache(max_bytes=128 * 2 ** 20)
+
+
+def surface_terms(order):
+    """exponents (i, j) of the monomials x^i y^j of a polynomial surface of the given order"""
+    return [(i, total - i) for total in range(order + 1) for i in range(total, -1, -1)]
+
+
+class SurfaceDesign:
+    """Design matrix (pixel, term) of the box -reach <= x, y < reach around a source, x and y scaled by reach,
+    with the pairwise products of its terms (pixel, term * term) for the normal equations"""
+
+    def __init__(self, reach, order):
+        u = np.arange(-reach, reach) / reach
+        x, y = np.meshgrid(u, u, indexing='ij')
+        self.design = np.stack([x.ravel() ** i * y.ravel() ** j for i, j in surface_terms(order)], axis=-1)
+        self.products = (self.design[:, :, None] * self.design[:, None, :]).reshape(len(self.design), -1)
+
+    @property
+    def nbytes(self):
+        return self.design.nbytes + self.products.nbytes
+
+
+def surface_design(reach, order):
+    """design matrix and term products of SurfaceDesign, read-only and cached per (reach, order)"""
+    entry = design_cache.get((reach, order), lambda: SurfaceDesign(reach, order))
+    return entry.design, entry.products
+
+
+class BackgroundSurface:
+    """Polynomial background surface of order N fitted by least squares.
+
+    robust ("huber" or "tukey") reweights the pixels iteratively by their residuals, clip rejects pixels further
+    than clip standard deviations from the mean residual as scipy.stats.sigmaclip does; both iterate until the
+    coefficients settle or for at most iterations refits.
+    """
+
+    TUNING = {"huber": 1.345, "tukey": 4.685}
+
+    def __init__(self, order=2, robust=None, clip=None, iterations=20, tolerance=1e-8):
+        if robust is not None and robust not in self.TUNING:
+            raise ValueError("Unknown robust weighting {}".format(robust))
+
+        self.order = order
+        self.robust = robust
+        self.clip = clip
+        self.iterations = iterations
+        self.tolerance = tolerance
+
+    def design(self, reach):
+        return surface_design(reach, self.order)
+
+    def fit(self, values: np.ndarray, masks: np.ndarray, reach):
+        """coefficients (mask, term) of the surface through values (pixel,) of the box of reach for every mask"""
+        design, products = self.design(reach)
+        masks = np.atleast_2d(masks)
+        included = masks
+        weights = masks.astype(float)
+        coefficients = self._solve(weights, values, design, products)
+
+        for _ in range(self.iterations if self.robust or self.clip else 0):
+            residuals = values - coefficients @ design.T
+
+            if self.clip is not None:
+                count = np.sum(included, axis=-1, keepdims=True)
+                mean = np.sum(residuals * included, axis=-1, keepdims=True) / count
+                std = np.sqrt(np.sum((residuals - mean) ** 2 * included, axis=-1, keepdims=True) / count)
+                included = masks & (np.abs(residuals - mean) <= self.clip * std)
+
+            weights = included.astype(float)
+            if self.robust is not None:
+                weights *= self._weights(residuals, included)
+
+            previous, coefficients = coefficients, self._solve(weights, values, design, products)
+            if np.all(np.abs(coefficients - previous) <= self.tolerance * (np.abs(previous) + self.tolerance)):
+                break
+
+        return coefficients
+
+    def _weights(self, residuals, included):
+        # residuals scaled by the MAD of the included pixels of each fit
+        masked = np.where(included, residuals, np.nan)
+        centre = np.nanmedian(masked, axis=-1, keepdims=True)
+        scale = 1.4826 * np.nanmedian(np.abs(masked - centre), axis=-1, keepdims=True)
+        scaled = np.abs(residuals) / (self.TUNING[self.robust] * np.maximum(scale, np.finfo(float).tiny))
+
+        if self.robust == "huber":
+            return np.minimum(1, 1 / np.maximum(scaled, np.finfo(float).tiny))
+        return np.where(scaled < 1, (1 - scaled ** 2) ** 2, 0)
+
+    @staticmethod
+    def _solve(weights, values, design, products):
+        terms = design.shape[-1]
+        normal = (weights @ products).reshape(-1, terms, terms)
+        right = weights @ (design * values[:, None])
+        return np.linalg.solve(normal, right[..., None])[..., 0]
@@ -1,29 +1,7 @@
-from astropy.io import fits
 from StarFunctions import StarImg, OOI
 import numpy as np
 from scipy import interpolate
 
-""" import data """
-
-cyc116_1_data = fits.open("../Data/sci_cyc116_1.fits")
-cyc116_2_data = fits.open("../Data/sci_cyc116_2.fits")
-
-cyc116 = StarImg("cyc116", cyc116_1_data[0], cyc116_2_data[0])
-
-ND4_1_data = fits.open("../Data/sci_ND4_1.fits")
-ND4_2_data = fits.open("../Data/sci_ND4_2.fits")
-
-ND4 = StarImg("ND4", ND4_1_data[0], ND4_2_data[0])
-
-ND4_filter_data = np.loadtxt("../Data/ND4_filter.txt", delimiter="\t", skiprows=1)
-
-Spread_1_data = fits.open("../Data/PSFiband.fits")
-Spread_2_data = fits.open("../Data/PSFrband.fits")
-
-PointSpread = StarImg("Point Spread", Spread_1_data[0], Spread_2_data[0])
-
-""" designate objects """
-
 """ central wavelength of filter """
 Rband_filter = 636.3
 Iband_filter = 789.7
@@ -31,43 +9,82 @@ Iband_filter = 789.7
 """ filter magnitudes B; V; G; J; H; K; """
 HD100453_fluxes = np.array([[8.09, 445], [7.79, 551], [7.7196, 464], [6.945, 1220], [6.39, 1630], [5.6, 2190]])
 
-ND4_filter = interpolate.interp1d(ND4_filter_data[:, 0], ND4_filter_data[:, 3])
-ND4.filter_reduction = [ND4_filter(Iband_filter), ND4_filter(Rband_filter)]
-
-cyc116_main_star = OOI("Main Star", 511, 512)
-cyc116_second_star = OOI("Second star", 301, 307)
-cyc116_third_star = OOI("Third star", 298, 724)
-cyc116_ghost1 = OOI("Ghost 1", 237, 386)
-cyc116_ghost2 = OOI("Ghost 2", 891, 598)
-cyc116_disk = OOI("Disk", 509, 509)
-
-ND4_main_star = OOI("Main Star", 512, 512)
-ND4_second_star = OOI("Second star", 301, 307)
-ND4_third_star = OOI("Third star", 298, 724)
-ND4_ghost1 = OOI("Ghost 1", 237, 386)
-ND4_ghost2 = OOI("Ghost 2", 891, 598)
-
-cyc116.add_object(cyc116_second_star)
-cyc116.add_object(cyc116_third_star)
-cyc116.add_object(cyc116_ghost1)
-cyc116.add_object(cyc116_ghost2)
-cyc116.add_object(cyc116_main_star)
-
-cyc116.set_disk(cyc116_disk)
-
-ND4.add_object(ND4_main_star)
-
-PointSpread_main_star = OOI("Main Star", 512, 512)
-
-PointSpread.add_object(PointSpread_main_star)
-""" calculates & saves """
-
-# cyc116.save()
-# ND4.save()
-# PointSpread.save()
-
-""" loads data """
-cyc116.load()
-ND4.load()
-PointSpread.load()
-print()
\ No newline at end of file
+""" observations, their objects and disk; nothing is opened before an observation is requested """
+
+OBSERVATIONS = {
+    "cyc116": {
+        "name": "cyc116",
+        "files": ("../Data/sci_cyc116_1.fits", "../Data/sci_cyc116_2.fits"),
+        "objects": {"second_star": ("Second star", 301, 307),
+                    "third_star": ("Third star", 298, 724),
+                    "ghost1": ("Ghost 1", 237, 386),
+                    "ghost2": ("Ghost 2", 891, 598),
+                    "main_star": ("Main Star", 511, 512)},
+        "disk": ("Disk", 509, 509),
+    },
+    "ND4": {
+        "name": "ND4",
+        "files": ("../Data/sci_ND4_1.fits", "../Data/sci_ND4_2.fits"),
+        "objects": {"main_star": ("Main Star", 512, 512)},
+        "filter": "../Data/ND4_filter.txt",
+    },
+    "PointSpread": {
+        "name": "Point Spread",
+        "files": ("../Data/PSFiband.fits", "../Data/PSFrband.fits"),
+        "objects": {"main_star": ("Main Star", 512, 512)},
+    },
+}
+
+_observations = {}
+_objects = {}
+_filters = {}
+
+
+def get_filter_data(path):
+    if path not in _filters:
+        _filters[path] = np.loadtxt(path, delimiter="\t", skiprows=1)
+    return _filters[path]
+
+
+def get_object(observation, key):
+    if (observation, key) not in _objects:
+        entry = OBSERVATIONS[observation]
+        _objects[observation, key] = OOI(*(entry["disk"] if key == "disk" else entry["objects"][key]))
+    return _objects[observation, key]
+
+
+def get_observation(key):
+    """StarImg of a registered observation, built, given its objects and loaded on first access"""
+    if key in _observations:
+        return _observations[key]
+
+    entry = OBSERVATIONS[key]
+    observation = StarImg.from_fits(entry["name"], *entry["files"])
+
+    for object_key in entry["objects"]:
+        observation.add_object(get_object(key, object_key))
+    if "disk" in entry:
+        observation.set_disk(get_object(key, "disk"))
+    if "filter" in entry:
+        filter_data = get_filter_data(entry["filter"])
+        transmission = interpolate.interp1d(filter_data[:, 0], filter_data[:, 3])
+        observation.filter_reduction = [transmission(Iband_filter), transmission(Rband_filter)]
+
+    observation.load()
+    _observations[key] = observation
+    return observation
+
+
+def __getattr__(name):
+    # keeps "from StarData import cyc116, cyc116_ghost2, ND4_filter_data" working on demand
+    if name in OBSERVATIONS:
+        return get_observation(name)
+    if name == "ND4_filter_data":
+        return get_filter_data(OBSERVATIONS["ND4"]["filter"])
+
+    for key, entry in OBSERVATIONS.items():
+        object_key = name[len(key) + 1:]
+        if name.startswith(key + "_") and (object_key in entry["objects"] or object_key == "disk" and "disk" in entry):
+            return get_object(key, object_key)
+
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
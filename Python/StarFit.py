@@ -0,0 +1,269 @@
+import inspect
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.interpolate import CubicSpline
+from scipy.ndimage import gaussian_filter1d
+from scipy.optimize import curve_fit
+from StarStore import MaskCache, array_hash
+
+SIGMA_GRID = np.linspace(0, 10, 201)
+
+blurred_cache = MaskCache(max_bytes=64 * 2 ** 20)
+
+
+def gaussian_blur(pos, sig):
+    # below sigma 0.125 gaussian_filter1d has a kernel of one pixel, sigma 0 is its limit
+    if sig <= 0:
+        return np.asarray(pos, dtype=float).copy()
+    return gaussian_filter1d(pos, sig)
+
+
+def scaling_func(pos, a, b):
+    return a * (pos - b)
+
+
+def linear_scaling_fit(pos, profile, sigma=None, mask=None):
+    """Weighted least squares fits of scaling_func along the last axis, all batches solved in closed form.
+
+    sigma as in curve_fit, mask selects the points of each fit (e.g. different regions on a common radius axis).
+    Returns the parameters (..., 2) and their covariance (..., 2, 2) as curve_fit with absolute_sigma=False.
+    """
+    pos, profile = np.broadcast_arrays(np.asarray(pos, dtype=float), np.asarray(profile, dtype=float))
+    weights = np.ones(pos.shape) if sigma is None else np.broadcast_to(1.0 / np.asarray(sigma) ** 2, pos.shape)
+    if mask is not None:
+        weights = np.where(mask, weights, 0)
+
+    # a * (x - b) is the straight line a * x + c with c = -a * b, solved around the weighted means
+    total = np.sum(weights, axis=-1)
+    pos_mean = np.sum(weights * pos, axis=-1) / total
+    profile_mean = np.sum(weights * profile, axis=-1) / total
+    dx = pos - pos_mean[..., None]
+    a = np.sum(weights * dx * (profile - profile_mean[..., None]), axis=-1) / np.sum(weights * dx ** 2, axis=-1)
+    b = pos_mean - profile_mean / a
+    params = np.stack((a, b), axis=-1)
+
+    # covariance from the Jacobian in (a, b) scaled by the reduced chi square
+    jac = np.stack((pos - b[..., None], np.broadcast_to(-a[..., None], pos.shape)), axis=-1)
+    normal = np.einsum('...ni,...n,...nj->...ij', jac, weights, jac)
+    residuals = profile - scaling_func(pos, a[..., None], b[..., None])
+    dof = np.sum(weights > 0, axis=-1) - 2
+    chi2 = np.sum(weights * residuals ** 2, axis=-1)
+    covariance = np.linalg.inv(normal) * (chi2 / dof)[..., None, None]
+    return params, covariance
+
+
+def scaling_gauss_func(pos, a, b, sig):
+    return a * (gaussian_blur(pos, sig) - b)
+
+
+class BlurredProfile:
+    """gaussian_filter1d of a profile tabulated over a grid of sigmas and interpolated by a cubic spline.
+
+    Sigmas outside the grid are blurred directly, their derivative is a central difference.
+    """
+
+    def __init__(self, profile, sigmas=SIGMA_GRID):
+        self.profile = np.array(profile, dtype=float)
+        self.sigmas = np.array(sigmas, dtype=float)
+        self.spline = CubicSpline(sigmas, [gaussian_blur(self.profile, sig) for sig in sigmas], axis=0)
+        self.derivative = self.spline.derivative()
+
+    @property
+    def nbytes(self):
+        return self.profile.nbytes + self.sigmas.nbytes + self.spline.c.nbytes + self.derivative.c.nbytes
+
+    def __call__(self, sig):
+        if self.sigmas[0] <= sig <= self.sigmas[-1]:
+            return self.spline(sig)
+        return gaussian_blur(self.profile, sig)
+
+    def slope(self, sig, step=1e-3):
+        if self.sigmas[0] <= sig <= self.sigmas[-1]:
+            return self.derivative(sig)
+        return (gaussian_blur(self.profile, sig + step) - gaussian_blur(self.profile, sig - step)) / (2 * step)
+
+
+def blurred_profile(profile, sigmas=SIGMA_GRID):
+    key = (array_hash(np.asarray(profile, dtype=float)), sigmas[0], sigmas[-1], len(sigmas))
+    return blurred_cache.get(key, lambda: BlurredProfile(profile, sigmas))
+
+
+class ProfileFit:
+    """Blurred PSF fits of a sequence of profiles with analytic Jacobians, the ND4 scaling is linear_scaling_fit.
+
+    Each fit starts from the solution of the previous profile, nfev records the model evaluations of every fit.
+    """
+
+    def __init__(self, sigmas=SIGMA_GRID):
+        self.sigmas = sigmas
+        self.psf = None
+        self.nfev = []
+
+    def fit_psf(self, pos, profile, sigma=None, bounds=([0, -np.inf, 0], np.inf)):
+        blurred = blurred_profile(pos, self.sigmas)
+        p0 = np.ones(3) if self.psf is None else self.psf.copy()
+        # below sigma 0.125 the blur is the identity and flat in sigma, a warm start there would not move
+        p0[2] = max(p0[2], 0.5)
+        calls = [0]
+
+        def model(_, a, b, sig):
+            calls[0] += 1
+            return a * (blurred(sig) - b)
+
+        def jac(_, a, b, sig):
+            return np.stack((blurred(sig) - b, np.full(blurred.profile.shape, -a), a * blurred.slope(sig)), axis=-1)
+
+        result = curve_fit(model, pos, profile, p0=p0, sigma=sigma, bounds=bounds, jac=jac)
+        self.psf = result[0]
+        self.nfev.append(("psf", calls[0]))
+        return result
+
+    def report(self):
+        return "Model evaluations: " + ", ".join("{} {}".format(label, n) for label, n in self.nfev)
+
+
+def range_sums(values, starts, ends):
+    """sums of values[..., start:end] for arrays of ranges, one cumulative sum and O(1) per range"""
+    values = np.asarray(values, dtype=float)
+    size = values.shape[-1]
+    cumulative = np.concatenate((np.zeros(values.shape[:-1] + (1,)), np.cumsum(values, axis=-1)), axis=-1)
+
+    starts = np.clip(starts, 0, size)
+    ends = np.maximum(np.clip(ends, 0, size), starts)
+    return cumulative[..., ends] - cumulative[..., starts]
+
+
+def wiggle_sums(values, start, end, inner=np.arange(-2, 3), outer=np.arange(-2, 3)):
+    """mean and std of the sums of values over [start + i, end + o) for every wiggle i in inner and o in outer"""
+    starts, ends = np.meshgrid(start + np.asarray(inner), end + np.asarray(outer), indexing='ij')
+    sums = range_sums(values, starts.ravel(), ends.ravel())
+    return np.mean(sums, axis=-1), np.std(sums, axis=-1)
+
+
+class EmptyTailError(ValueError):
+    """raised by fit_profiles when smart finds no tail points to fit the PSF on"""
+
+
+def fit_profiles(cyc116_profiles, nd4_profiles, psf_profiles, qphi_profiles, circumference, start_int=14,
+                 end_int=65, start_peak=0, end_peak=32, transition=21,
+                 tail=np.linspace(120, 200, 8, dtype=int, endpoint=False), smart=False, disk_range=(32, 118),
+                 wiggle=2):
+    """ND4 scaling, mixed profile splice and PSF fit of all bands (band, radius) for one set of fit parameters.
+
+    Returns a dict with the fits, the profiles and the disk and Qphi counts (band, [disk, qphi], [mean, std])
+    summed over disk_range with both ends wiggled by up to wiggle bins.
+    """
+    nd4_region = np.arange(start_int, end_int)
+    nd4_weights = np.ones(nd4_region.shape)
+    scaling = linear_scaling_fit(nd4_profiles[:, nd4_region], cyc116_profiles[:, nd4_region], sigma=nd4_weights)
+    scaled = scaling_func(nd4_profiles, scaling[0][:, :1], scaling[0][:, 1:])
+
+    mixed = cyc116_profiles.copy()
+    mixed[:, :transition] = scaled[:, :transition]
+
+    fit = ProfileFit()
+    out = {"nd4_region": nd4_region, "nd4_weights": nd4_weights, "scaling": scaling, "scaled": scaled,
+           "mixed": mixed, "tails": [], "psf_regions": [], "psf_weights": [], "psf": [], "star": [],
+           "counts": np.zeros((len(mixed), 2, 2))}
+
+    for band, (cyc116_profile, scaled_profile, mixed_profile) in enumerate(zip(cyc116_profiles, scaled, mixed)):
+        if smart:
+            band_tail = np.flatnonzero(np.abs(scaled_profile[120:200] - cyc116_profile[120:200]) <= 0.6827) + 120
+            if len(band_tail) == 0:
+                raise EmptyTailError("No tail points of band {} satisfy the smart condition".format(band))
+            band_tail = band_tail[::-len(band_tail) // 8][::-1]
+            psf_region = np.concatenate((np.arange(end_peak), band_tail))
+            psf_weights = np.concatenate((np.full((end_peak,), 4.50), np.full_like(band_tail, 1)))
+        else:
+            band_tail = np.asarray(tail)
+            psf_region = np.concatenate((np.arange(start_peak, end_peak), band_tail))
+            psf_weights = np.concatenate((np.full((end_peak - start_peak,), 15), np.full_like(band_tail, 1)))
+
+        psf_factor = fit.fit_psf(psf_profiles[band][psf_region], mixed_profile[psf_region], sigma=psf_weights)
+        star = scaling_gauss_func(psf_profiles[band], *psf_factor[0])
+
+        disk = mixed_profile - star
+        disk[disk < 0] = 0
+        int_range = np.arange(-wiggle, wiggle + 1)
+        counts = wiggle_sums(np.array([disk, qphi_profiles[band]]) * circumference, *disk_range, int_range, int_range)
+
+        out["tails"].append(band_tail)
+        out["psf_regions"].append(psf_region)
+        out["psf_weights"].append(psf_weights)
+        out["psf"].append(psf_factor)
+        out["star"].append(star)
+        out["counts"][band] = np.transpose(counts)
+
+    out["star"] = np.array(out["star"])
+    out["fit"] = fit
+    return out
+
+
+SWEEP_PARAMETERS = ("start_int", "end_int", "end_peak", "transition", "tail", "smart")
+
+SWEEP_DTYPE = np.dtype([("start_int", "i8"), ("end_int", "i8"), ("end_peak", "i8"), ("transition", "i8"),
+                        ("tail", "i8"), ("smart", "?"), ("band", "i8"), ("scaling", "f8", 2),
+                        ("scaling_err", "f8", 2), ("psf", "f8", 3), ("psf_err", "f8", 3), ("disk", "f8", 2),
+                        ("qphi", "f8", 2), ("nfev", "i8")])
+
+_sweep_profiles = None
+
+
+def _init_sweep(profiles):
+    global _sweep_profiles
+    _sweep_profiles = profiles
+
+
+def _sweep_job(parameters):
+    try:
+        return fit_profiles(*_sweep_profiles, **parameters)
+    except RuntimeError:
+        # curve_fit did not converge
+        return None
+    except EmptyTailError:
+        return None
+
+
+def sweep_fits(cyc116_profiles, nd4_profiles, psf_profiles, qphi_profiles, circumference, grid, max_workers=None):
+    """Runs fit_profiles for every combination of the grid on a process pool, nothing is plotted.
+
+    grid maps names of SWEEP_PARAMETERS to lists of values, tail to a list of tail arrays; missing names keep
+    the defaults of fit_profiles. Returns a table with one row per combination and band, tail is the index
+    into grid["tail"]; combinations whose fit did not converge or had no smart tail have nan fits.
+    """
+    names = [name for name in SWEEP_PARAMETERS if name in grid]
+    # tails are arrays, the combinations refer to them by their index in the grid
+    values = [range(len(grid[name])) if name == "tail" else grid[name] for name in names]
+    combinations = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+    jobs = [dict(combination, tail=grid["tail"][combination["tail"]]) if "tail" in combination else combination
+            for combination in combinations]
+    profiles = (cyc116_profiles, nd4_profiles, psf_profiles, qphi_profiles, circumference)
+
+    with ProcessPoolExecutor(max_workers, initializer=_init_sweep, initargs=(profiles,)) as executor:
+        results = list(executor.map(_sweep_job, jobs))
+
+    defaults = inspect.signature(fit_profiles).parameters
+    n_bands = len(cyc116_profiles)
+    table = np.zeros(len(combinations) * n_bands, dtype=SWEEP_DTYPE)
+    for name in ("scaling", "scaling_err", "psf", "psf_err", "disk", "qphi"):
+        table[name] = np.nan
+
+    for index, (combination, result) in enumerate(zip(combinations, results)):
+        rows = table[index * n_bands:(index + 1) * n_bands]
+        rows["band"] = np.arange(n_bands)
+        for name in ("start_int", "end_int", "end_peak", "transition", "smart"):
+            rows[name] = combination.get(name, defaults[name].default)
+        rows["tail"] = combination.get("tail", -1)
+        if result is None:
+            continue
+
+        rows["scaling"] = result["scaling"][0]
+        rows["scaling_err"] = np.sqrt(np.diagonal(result["scaling"][1], axis1=-2, axis2=-1))
+        rows["psf"] = [popt for popt, _ in result["psf"]]
+        rows["psf_err"] = [np.sqrt(np.diag(pcov)) for _, pcov in result["psf"]]
+        rows["disk"] = result["counts"][:, 0]
+        rows["qphi"] = result["counts"][:, 1]
+        rows["nfev"] = [n for _, n in result["fit"].nfev]
+
+    return table
@@ -1,31 +1,219 @@
 import matplotlib.pyplot as plt
+from astropy.io import fits
 from mpl_toolkits.mplot3d import Axes3D
 from typing import List
 import itertools
-from scipy.optimize import curve_fit
+from scipy import ndimage
 from scipy.stats import sigmaclip
 import numpy as np
-import pickle
+from StarBackground import SlidingBackground, BackgroundSurface, sigmaclip_median
+from StarStore import ProductStore, ProductCache, MaskCache, array_hash
 import os
 
 plt.rcParams["image.origin"] = 'lower'
 full_file_path = os.getcwd()
 
+PRODUCTS = ("radial", "azimuthal", "azimuthal_qphi")
+AZIMUTHAL_NAMES = ["i_band", "i_band_iu", "r_band", "r_band_iu"]
+BAND_NAMES = ["i_band", "r_band"]
 
-def aperture(shape, cx, cy, radius, hole=0):
-    y, x = np.ogrid[:shape[0], :shape[1]]
-    distance = np.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+_product_cache = None
+
+
+def get_product_cache():
+    """the shared ProductCache, created on first use so that importing does not read its manifest"""
+    global _product_cache
+    if _product_cache is None:
+        _product_cache = ProductCache(full_file_path + "/../Data/cache")
+    return _product_cache
+
+
+mask_cache = MaskCache()
+geometry_cache = MaskCache(max_bytes=128 * 2 ** 20)
+
+
+class PolarGeometry:
+    """Polarisation angle maps of a frame around a centre, stored as float32; the radius is radius_map"""
+
+    def __init__(self, shape, cx, cy):
+        y, x = np.ogrid[:shape[0], :shape[1]]
+        phi = angle_phi(x, y, cx, cy)
+
+        self.phi = phi.astype(np.float32)
+        self.sin_2phi = np.sin(2 * phi).astype(np.float32)
+        self.cos_2phi = np.cos(2 * phi).astype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.phi.nbytes + self.sin_2phi.nbytes + self.cos_2phi.nbytes
+
+
+def polar_geometry(shape, cx, cy):
+    return geometry_cache.get((tuple(shape), cx, cy), lambda: PolarGeometry(shape, cx, cy))
+
+
+def radius_map(shape, cx, cy):
+    """distance of every pixel to the centre as float32, the one radius map shared by apertures and profiles"""
+    def factory():
+        y, x = np.ogrid[:shape[0], :shape[1]]
+        return np.sqrt((x - cx) ** 2 + (y - cy) ** 2).astype(np.float32)
+
+    return mask_cache.get(("radius", tuple(shape), cx, cy), factory)
+
+
+def _aperture(shape, cx, cy, radius, hole=0):
+    distance = radius_map(shape, cx, cy)
     mask = (hole <= distance) & (distance < radius)
     return mask
 
 
+def aperture(shape, cx, cy, radius, hole=0):
+    return mask_cache.get(("full", tuple(shape), cx, cy, radius, hole),
+                          lambda: _aperture(shape, cx, cy, radius, hole))
+
+
+class CutoutAperture:
+    """Aperture mask restricted to the bounding box of the circle, placed into the frame by its offset"""
+
+    def __init__(self, shape, cx, cy, radius, hole=0):
+        self.shape = shape
+        self.y0 = min(max(int(np.floor(cy - radius)), 0), shape[0])
+        self.x0 = min(max(int(np.floor(cx - radius)), 0), shape[1])
+        y1 = max(min(int(np.ceil(cy + radius)) + 1, shape[0]), self.y0)
+        x1 = max(min(int(np.ceil(cx + radius)) + 1, shape[1]), self.x0)
+        self.slices = (slice(self.y0, y1), slice(self.x0, x1))
+
+        y, x = np.ogrid[self.y0:y1, self.x0:x1]
+        distance = np.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+        self.mask = (hole <= distance) & (distance < radius)
+        self.count = np.sum(self.mask)
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes
+
+    def values(self, image: np.ndarray):
+        return image[..., self.slices[0], self.slices[1]][..., self.mask]
+
+    def add_to(self, frame: np.ndarray, value=1.0):
+        frame[self.slices][self.mask] += value
+        return frame
+
+    def full(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[self.slices] = self.mask
+        return mask
+
+
+def cutout_aperture(shape, cx, cy, radius, hole=0):
+    return mask_cache.get(("cutout", tuple(shape), cx, cy, radius, hole),
+                          lambda: CutoutAperture(shape, cx, cy, radius, hole))
+
+
+def _circle_quadrant(x, y, radius):
+    """signed area of the circle around the origin between the axes and the point (x, y)"""
+    sign = np.sign(x) * np.sign(y)
+    x, y = np.minimum(np.abs(x), radius), np.minimum(np.abs(y), radius)
+
+    # the circle boundary crosses the height y at x_cross, beyond it the area follows the arc
+    x_cross = np.sqrt(radius ** 2 - y ** 2)
+    x_arc = np.maximum(x, x_cross)
+
+    def arc(t):
+        return 0.5 * (t * np.sqrt(np.maximum(radius ** 2 - t ** 2, 0)) + radius ** 2 * np.arcsin(t / radius))
+
+    return sign * np.where(x <= x_cross, x * y, x_cross * y + arc(x_arc) - arc(x_cross))
+
+
+def circle_overlap(x0, x1, y0, y1, radius):
+    """area of the rectangles [x0, x1] x [y0, y1] inside the circle of radius around the origin"""
+    if radius <= 0:
+        return np.zeros(np.broadcast(x0, x1, y0, y1).shape)
+
+    return (_circle_quadrant(x1, y1, radius) - _circle_quadrant(x0, y1, radius) -
+            _circle_quadrant(x1, y0, radius) + _circle_quadrant(x0, y0, radius))
+
+
+class ExactAperture:
+    """Aperture weighting each pixel by its exact fractional overlap with the circle or annulus, float centres.
+
+    count is the area; the pixels only enter weighted, through sum() and add_to().
+    """
+
+    def __init__(self, shape, cx, cy, radius, hole=0):
+        y0 = min(max(int(np.floor(cy - radius)) - 1, 0), shape[0])
+        x0 = min(max(int(np.floor(cx - radius)) - 1, 0), shape[1])
+        y1 = max(min(int(np.ceil(cy + radius)) + 2, shape[0]), y0)
+        x1 = max(min(int(np.ceil(cx + radius)) + 2, shape[1]), x0)
+        self.slices = (slice(y0, y1), slice(x0, x1))
+
+        y, x = np.ogrid[y0:y1, x0:x1]
+        x, y = x - cx, y - cy
+        self.weights = circle_overlap(x - 0.5, x + 0.5, y - 0.5, y + 0.5, radius) - \
+            circle_overlap(x - 0.5, x + 0.5, y - 0.5, y + 0.5, hole)
+        self.count = np.sum(self.weights)
+
+    @property
+    def nbytes(self):
+        return self.weights.nbytes
+
+    def sum(self, image: np.ndarray):
+        return np.sum(image[..., self.slices[0], self.slices[1]] * self.weights, axis=(-2, -1))
+
+    def add_to(self, frame: np.ndarray, value=1.0):
+        frame[self.slices] += value * self.weights
+        return frame
+
+
+def exact_aperture(shape, cx, cy, radius, hole=0):
+    return mask_cache.get(("exact", tuple(shape), cx, cy, radius, hole),
+                          lambda: ExactAperture(shape, cx, cy, radius, hole))
+
+
 def angle_phi(x, y, x0, y0):
-    size = len(y)
-    out = np.zeros((size, size))
-    out[:, :x0] = -np.inf
-    out[:, x0 + 1:] = np.inf
-    results = np.true_divide(x - x0, y - y0, out=out, where=(x == x) & (y != y0))
-    return np.arctan(results)
+    # arctan((x - x0) / (y - y0)) folded into [-pi/2, pi/2], including the row y == y0
+    phi = np.arctan2(x - x0, y - y0)
+    return np.where(phi > np.pi / 2, phi - np.pi, np.where(phi < -np.pi / 2, phi + np.pi, phi))
+
+
+def radial_polarization(stack: np.ndarray, centre=None, out=None, dtype=None):
+    """Q_phi and U_phi of a (..., stokes, y, x) stack such as (obs, band, stokes, y, x), as (..., 2, y, x).
+
+    All frames are transformed in one broadcast against the cached geometry. out can be a preallocated
+    buffer of the result shape; dtype=np.float32 halves the memory of the result.
+    """
+    shape = stack.shape[-2:]
+    if centre is None:
+        centre = (shape[1] // 2, shape[0] // 2)
+    if dtype is None:
+        dtype = out.dtype if out is not None else np.result_type(stack.dtype, np.float64)
+    if out is None:
+        out = np.empty(stack.shape[:-3] + (2,) + shape, dtype=dtype)
+
+    geometry = polar_geometry(shape, *centre)
+    q, u = stack[..., 1, :, :], stack[..., 3, :, :]
+    q_phi, u_phi = out[..., 0, :, :], out[..., 1, :, :]
+    scratch = np.empty(q_phi.shape, dtype=dtype)
+
+    # q_phi = -Q cos(2 phi) + U sin(2 phi), u_phi = Q sin(2 phi) + U cos(2 phi)
+    np.multiply(u, geometry.sin_2phi, out=q_phi, casting='unsafe')
+    np.multiply(q, geometry.cos_2phi, out=scratch, casting='unsafe')
+    np.subtract(q_phi, scratch, out=q_phi)
+    np.multiply(q, geometry.sin_2phi, out=u_phi, casting='unsafe')
+    np.multiply(u, geometry.cos_2phi, out=scratch, casting='unsafe')
+    np.add(u_phi, scratch, out=u_phi)
+
+    return out
+
+
+def observation_stack(observations, dtype=None):
+    """(obs, band, stokes, y, x) stack of the I and R band images of several StarImg, filled in place"""
+    first = observations[0].get_i_img()
+    stack = np.empty((len(observations), 2) + first.shape, dtype=dtype or first.dtype)
+    for index, observation in enumerate(observations):
+        stack[index, 0] = observation.get_i_img()
+        stack[index, 1] = observation.get_r_img()
+    return stack
 
 
 def magnitude_wavelength_plot(fix_points, x):
@@ -64,13 +252,13 @@ def photometrie(irad: int, orad: int, pos: tuple, data_i: np.ndarray, data_r: np
         for index_or, outer_range in np.ndenumerate(radius_range):
             for shift in itertools.product(displacement_range, repeat=2):
                 new_pos = tuple(map(sum, zip(pos, shift)))
-                i_mask = aperture(shape, *new_pos, irad + inner_range)
-                o_mask = aperture(shape, *new_pos, orad + outer_range, irad + inner_range)
+                i_ap = cutout_aperture(shape, *new_pos, irad + inner_range)
+                o_ap = cutout_aperture(shape, *new_pos, orad + outer_range, irad + inner_range)
                 # np.median(sigmaclip(data_[i][o_mask])[0])
-                flux_iq = np.sum(data_i[0][i_mask]) - np.sum(i_mask) * np.median(sigmaclip(data_i[0][o_mask])[0])
-                flux_rq = np.sum(data_r[0][i_mask]) - np.sum(i_mask) * np.median(sigmaclip(data_r[0][o_mask])[0])
-                flux_iu = np.sum(data_i[2][i_mask]) - np.sum(i_mask) * np.median(sigmaclip(data_i[2][o_mask])[0])
-                flux_ru = np.sum(data_r[2][i_mask]) - np.sum(i_mask) * np.median(sigmaclip(data_r[2][o_mask])[0])
+                flux_iq = np.sum(i_ap.values(data_i[0])) - i_ap.count * np.median(sigmaclip(o_ap.values(data_i[0]))[0])
+                flux_rq = np.sum(i_ap.values(data_r[0])) - i_ap.count * np.median(sigmaclip(o_ap.values(data_r[0]))[0])
+                flux_iu = np.sum(i_ap.values(data_i[2])) - i_ap.count * np.median(sigmaclip(o_ap.values(data_i[2]))[0])
+                flux_ru = np.sum(i_ap.values(data_r[2])) - i_ap.count * np.median(sigmaclip(o_ap.values(data_r[2]))[0])
 
                 results[shift[0] + displ, shift[1] + displ, index_ir[0], index_or[0]] = [flux_iq, flux_iu, flux_rq,
                                                                                          flux_ru]
@@ -81,6 +269,80 @@ def photometrie(irad: int, orad: int, pos: tuple, data_i: np.ndarray, data_r: np
     return np.nanmean(results, axis=(0, 1, 2, 3)), np.nanstd(results, axis=(0, 1, 2, 3))
 
 
+def photometrie_fast(irad: int, orad: int, pos: tuple, data_i: np.ndarray, data_r: np.ndarray, displ: int = 1,
+                     scale: int = 1, trans_filter=None, res=False):
+    """Same as photometrie, but every radius combination is read off the pixels sorted by distance"""
+    if trans_filter is None:
+        trans_filter = [1, 1]
+
+    if irad > orad:
+        raise ValueError("The outer radius needs to be bigger than the inner radius")
+
+    displacement_range = np.arange(-displ, displ + 1)
+    radius_range = np.arange(-scale, scale + 1)
+    shape = data_i[0].shape
+    results = np.full((2 * displ + 1, 2 * displ + 1, 2 * scale + 1, 2 * scale + 1, 4), np.nan)
+
+    # channel order of the results: I-Q, I-U, R-Q, R-U
+    channels = [(data_i, 0, trans_filter[0]), (data_i, 2, trans_filter[0]),
+                (data_r, 0, trans_filter[1]), (data_r, 2, trans_filter[1])]
+    max_radius = orad + scale
+
+    for shift in itertools.product(displacement_range, repeat=2):
+        cx, cy = pos[0] + shift[0], pos[1] + shift[1]
+        y_lo, y_hi = max(int(np.floor(cy - max_radius)), 0), min(int(np.ceil(cy + max_radius)) + 1, shape[0])
+        x_lo, x_hi = max(int(np.floor(cx - max_radius)), 0), min(int(np.ceil(cx + max_radius)) + 1, shape[1])
+
+        y, x = np.ogrid[y_lo:y_hi, x_lo:x_hi]
+        distance = np.sqrt((x - cx) ** 2 + (y - cy) ** 2).ravel()
+        order = np.argsort(distance, kind='stable')
+        distance = distance[order]
+
+        values = np.array([data[plane, y_lo:y_hi, x_lo:x_hi].ravel()[order] / reduction
+                           for data, plane, reduction in channels])
+        cumulative = np.concatenate((np.zeros((4, 1)), np.cumsum(values, axis=1)), axis=1)
+
+        for index_ir, inner_range in np.ndenumerate(radius_range):
+            n_in = np.searchsorted(distance, irad + inner_range, side='left')
+            for index_or, outer_range in np.ndenumerate(radius_range):
+                n_out = np.searchsorted(distance, orad + outer_range, side='left')
+                # the annulus of all four channels is clipped in one pass
+                background, _ = sigmaclip_median(values[:, n_in:max(n_in, n_out)])
+
+                results[shift[0] + displ, shift[1] + displ, index_ir[0], index_or[0]] = \
+                    cumulative[:, n_in] - n_in * background
+
+    if res:
+        return np.nanmean(results, axis=(0, 1, 2, 3)), np.nanstd(results, axis=(0, 1, 2, 3)), results
+
+    return np.nanmean(results, axis=(0, 1, 2, 3)), np.nanstd(results, axis=(0, 1, 2, 3))
+
+
+def photometrie_exact(irad, orad, pos: tuple, data_i: np.ndarray, data_r: np.ndarray, trans_filter=None):
+    """Fluxes I-Q, I-U, R-Q, R-U of one exact-overlap aperture at a float position, no jitter grid needed.
+
+    The background is the clipped median of the annulus pixels whose centres lie inside it.
+    """
+    if trans_filter is None:
+        trans_filter = [1, 1]
+
+    if irad > orad:
+        raise ValueError("The outer radius needs to be bigger than the inner radius")
+
+    shape = data_i[0].shape
+    i_ap = exact_aperture(shape, *pos, irad)
+    o_ap = cutout_aperture(shape, *pos, orad, irad)
+
+    # channel order of the results: I-Q, I-U, R-Q, R-U
+    channels = [(data_i, 0, trans_filter[0]), (data_i, 2, trans_filter[0]),
+                (data_r, 0, trans_filter[1]), (data_r, 2, trans_filter[1])]
+    totals = np.array([i_ap.sum(data[plane]) / reduction for data, plane, reduction in channels])
+    background, _ = sigmaclip_median(np.array([o_ap.values(data[plane]) / reduction
+                                               for data, plane, reduction in channels]))
+
+    return totals - i_ap.count * background
+
+
 def photometrie_disk(hole: int, irad: int, orad: int, pos: tuple, data_i: np.ndarray, data_r: np.ndarray,
                      displ: int = 1, scale: int = 1, res=False, bg=False):
     if irad > orad or hole > irad:
@@ -88,23 +350,29 @@ def photometrie_disk(hole: int, irad: int, orad: int, pos: tuple, data_i: np.nda
 
     displacement_range = np.arange(-displ, displ + 1)
     radius_range = np.arange(-scale, scale + 1)
-    shape = data_i.shape
     results = np.full((2 * displ + 1, 2 * displ + 1, 2 * scale + 1, 2 * scale + 1, 2 * scale + 1, 2), np.nan)
     bgs = results.copy()
 
-    for index_h, hole_range in np.ndenumerate(radius_range):
+    for shift in itertools.product(displacement_range, repeat=2):
+        new_pos = tuple(map(sum, zip(pos, shift)))
+        estimators = [SlidingBackground(data, *new_pos, orad + scale) for data in (data_i, data_r)]
+
         for index_ir, inner_range in np.ndenumerate(radius_range):
             for index_or, outer_range in np.ndenumerate(radius_range):
-                for shift in itertools.product(displacement_range, repeat=2):
-                    new_pos = tuple(map(sum, zip(pos, shift)))
-                    i_mask = aperture(shape, *new_pos, irad + inner_range, hole + hole_range)
-                    o_mask = aperture(shape, *new_pos, orad + outer_range, irad + inner_range)
+                # neighbouring annuli differ by one ring, each median is shared by all holes
+                medians = []
+                for estimator in estimators:
+                    estimator.set_annulus(irad + inner_range, orad + outer_range)
+                    medians.append(estimator.median())
 
-                    flux_i = np.sum(data_i[i_mask]) - np.sum(i_mask) * np.median(data_i[o_mask])
-                    flux_r = np.sum(data_r[i_mask]) - np.sum(i_mask) * np.median(data_r[o_mask])
-                    bgs[shift[0] + displ, shift[1] + displ, index_h[0], index_ir[0], index_or[0]] = [
-                        np.median(data_i[o_mask]), np.median(data_r[o_mask])]
-                    results[shift[0] + displ, shift[1] + displ, index_h[0], index_ir[0], index_or[0]] = [flux_i, flux_r]
+                for index_h, hole_range in np.ndenumerate(radius_range):
+                    fluxes = []
+                    for estimator, median in zip(estimators, medians):
+                        total, count = estimator.aperture_sum(hole + hole_range, irad + inner_range)
+                        fluxes.append(total - count * median)
+
+                    bgs[shift[0] + displ, shift[1] + displ, index_h[0], index_ir[0], index_or[0]] = medians
+                    results[shift[0] + displ, shift[1] + displ, index_h[0], index_ir[0], index_or[0]] = fluxes
 
     if res:
         return np.nanmean(results, axis=(0, 1, 2, 3, 4)), np.nanstd(results, axis=(0, 1, 2, 3, 4)), results
@@ -115,61 +383,260 @@ def photometrie_disk(hole: int, irad: int, orad: int, pos: tuple, data_i: np.nda
     return np.nanmean(results, axis=(0, 1, 2, 3, 4)), np.nanstd(results, axis=(0, 1, 2, 3, 4))
 
 
-def azimuthal_averaged_profile(image: np.ndarray):
+def catalogue_labels(shape, positions, inner_radius, outer_radius):
+    """Label image of a catalogue of targets at positions (x, y).
+
+    Every pixel closer than outer_radius to a target belongs to its nearest target, label 2 * target for the
+    aperture (distance < inner_radius) and 2 * target + 1 for the annulus, all other pixels are -1.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    reach = int(np.ceil(outer_radius)) + 1
+    offset = np.arange(-reach, reach + 1)
+
+    # candidate pixels of every target come from one shared box of offsets around its floored position
+    base = np.floor(positions).astype(int)
+    x = (base[:, 0, None, None] + offset[None, None, :]).repeat(offset.size, axis=1)
+    y = (base[:, 1, None, None] + offset[None, :, None]).repeat(offset.size, axis=2)
+    distance = np.sqrt((x - positions[:, 0, None, None]) ** 2 + (y - positions[:, 1, None, None]) ** 2)
+    target = np.broadcast_to(np.arange(len(positions))[:, None, None], distance.shape)
+
+    keep = (distance < outer_radius) & (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0])
+    pixel, distance, target = (y * shape[1] + x)[keep], distance[keep], target[keep]
+
+    # the nearest target comes first for each pixel
+    order = np.lexsort((target, distance, pixel))
+    pixel, distance, target = pixel[order], distance[order], target[order]
+    first = np.concatenate(([True], pixel[1:] != pixel[:-1]))
+
+    labels = np.full(shape, -1, dtype=np.int64)
+    labels.flat[pixel[first]] = 2 * target[first] + (distance[first] >= inner_radius)
+    return labels
+
+
+def catalogue_photometrie(images: np.ndarray, positions, inner_radius, outer_radius):
+    """Aperture photometry of a catalogue of targets on a stack of images (band, y, x) in a single pass.
+
+    Returns the label image, the aperture sums and annulus medians (target, band) and the pixel counts
+    (target, [aperture, annulus]).
+    """
+    images = np.asarray(images).reshape((-1,) + np.shape(images)[-2:])
+    labels = catalogue_labels(images.shape[-2:], positions, inner_radius, outer_radius)
+    n_labels = 2 * len(np.reshape(positions, (-1, 2)))
+
+    pixels = np.flatnonzero(labels >= 0)
+    groups = labels.flat[pixels]
+    values = images.reshape(len(images), -1)[:, pixels]
+
+    counts = np.bincount(groups, minlength=n_labels)
+    sums = np.array([np.bincount(groups, weights=band, minlength=n_labels) for band in values])
+
+    # medians of each group from one sort by group then value
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    lower = starts + np.maximum(counts - 1, 0) // 2
+    upper = starts + counts // 2
+    medians = np.full_like(sums, np.nan)
+    for band, band_values in enumerate(values):
+        ordered = band_values[np.lexsort((band_values, groups))]
+        if ordered.size:
+            medians[band] = np.where(counts > 0, 0.5 * (ordered[np.minimum(lower, ordered.size - 1)] +
+                                                        ordered[np.minimum(upper, ordered.size - 1)]), np.nan)
+
+    return labels, sums[:, 0::2].T, medians[:, 1::2].T, counts.reshape(-1, 2)
+
+
+def detect_sources(image: np.ndarray, sigma=2.0, threshold=5.0, min_pixels=5, max_sources=None, name="Source"):
+    """Finds the sources of an intensity image as OOIs with sub-pixel positions and fluxes, brightest first.
+
+    The image is smoothed by a gaussian of width sigma and thresholded at threshold times the robust noise
+    (MAD) above the median; every connected region of at least min_pixels pixels is one source. Position
+    and flux are the background subtracted centroid and sum of the unsmoothed image over the region.
+    """
+    image = np.nan_to_num(np.asarray(image, dtype=float))
+    smoothed = ndimage.gaussian_filter(image, sigma)
+
+    level = np.median(smoothed)
+    noise = 1.4826 * np.median(np.abs(smoothed - level))
+    labels, n_regions = ndimage.label(smoothed > level + threshold * noise)
+    if n_regions == 0:
+        return []
+
+    # every region reduced in one bincount over the flat label image
+    flat = labels.ravel()
+    y, x = np.indices(image.shape).reshape(2, -1)
+    signal = image.ravel() - np.median(image)
+    counts = np.bincount(flat, minlength=n_regions + 1)[1:]
+    flux = np.bincount(flat, weights=signal, minlength=n_regions + 1)[1:]
+    positive = np.maximum(signal, 0)
+    weights = np.bincount(flat, weights=positive, minlength=n_regions + 1)[1:]
+    pos_x = np.bincount(flat, weights=positive * x, minlength=n_regions + 1)[1:] / np.maximum(weights, 1e-300)
+    pos_y = np.bincount(flat, weights=positive * y, minlength=n_regions + 1)[1:] / np.maximum(weights, 1e-300)
+
+    regions = np.flatnonzero((counts >= min_pixels) & (weights > 0))
+    regions = regions[np.argsort(-flux[regions], kind='stable')][:max_sources]
+    return [OOI("{} {}".format(name, index + 1), pos_x[region], pos_y[region], flux[region])
+            for index, region in enumerate(regions)]
+
+
+def radial_profile(image: np.ndarray, centres=None, bin_width=1.0, statistics=("mean",), max_radius=None,
+                   low=4.0, high=4.0):
+    """Radial profiles of an image around one or several (x, y) centres, all statistics in one grouped pass.
+
+    statistics can be "mean", "median", "std", "clipped_mean" (sigma clipped with low/high), "count" (non NaN
+    pixels), "pixels" (all pixels) or a percentile such as 90 or "p90". Several centres are binned together,
+    with their radius maps taken from the geometry cache; the results then have one row per centre.
+    Returns the inner radius of each bin and a dict with one array per statistic.
+    """
+    if centres is None:
+        centres = (image.shape[1] // 2, image.shape[0] // 2)
+    if max_radius is None:
+        max_radius = min(image.shape) // 2
+
+    centres = np.asarray(centres, dtype=float)
+    single = centres.ndim == 1
+    centres = np.atleast_2d(centres)
+    n_bins = int(np.ceil(max_radius / bin_width))
+    n_groups = len(centres) * n_bins
+
+    distance = np.array([radius_map(image.shape, cx, cy) for cx, cy in centres.tolist()])
+    bins = np.floor(distance / bin_width).astype(int).reshape(len(centres), -1)
+
+    inside = bins < n_bins
+    labels = (bins + n_bins * np.arange(len(centres))[:, None])[inside]
+    values = np.broadcast_to(image.ravel(), bins.shape)[inside]
+
+    profiles = {}
+    if "pixels" in statistics:
+        profiles["pixels"] = np.bincount(labels, minlength=n_groups)
+
+    valid = ~np.isnan(values)
+    labels, values = labels[valid], values[valid]
+    counts = np.bincount(labels, minlength=n_groups)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(labels, values, minlength=n_groups) / counts
+        std = np.sqrt(np.bincount(labels, (values - mean[labels]) ** 2, minlength=n_groups) / counts)
+
+        clipped_mean = _grouped_clipped_mean(labels, values, n_groups, low, high) \
+            if "clipped_mean" in statistics else None
+
+    ordered = values[np.lexsort((values, labels))]
+    starts = np.cumsum(counts) - counts
+    last = max(ordered.size - 1, 0)
+
+    def percentile(q):
+        position = starts + q / 100 * np.maximum(counts - 1, 0)
+        lower = ordered[np.minimum(np.floor(position).astype(int), last)]
+        upper = ordered[np.minimum(np.ceil(position).astype(int), last)]
+        fraction = position - np.floor(position)
+        return np.where(counts > 0, lower + (upper - lower) * fraction, np.nan)
+
+    for statistic in statistics:
+        if statistic == "mean":
+            profiles[statistic] = mean
+        elif statistic == "std":
+            profiles[statistic] = std
+        elif statistic == "count":
+            profiles[statistic] = counts
+        elif statistic == "clipped_mean":
+            profiles[statistic] = clipped_mean
+        elif statistic == "median":
+            lower = ordered[np.minimum(starts + np.maximum(counts - 1, 0) // 2, last)]
+            upper = ordered[np.minimum(starts + counts // 2, last)]
+            profiles[statistic] = np.where(counts > 0, 0.5 * (lower + upper), np.nan)
+        elif statistic != "pixels":
+            profiles[statistic] = percentile(float(str(statistic).lstrip("p")))
+
+    for statistic, profile in profiles.items():
+        profiles[statistic] = profile[:n_bins] if single else profile.reshape(len(centres), n_bins)
+
+    return np.arange(n_bins) * bin_width, profiles
+
+
+def _grouped_clipped_mean(labels, values, n_groups, low, high):
+    """mean after scipy.stats.sigmaclip of every group of values"""
+    keep = np.ones_like(values, dtype=bool)
+    while True:
+        counts = np.bincount(labels, keep, minlength=n_groups)
+        mean = np.bincount(labels, values * keep, minlength=n_groups) / counts
+        std = np.sqrt(np.bincount(labels, keep * (values - mean[labels]) ** 2, minlength=n_groups) / counts)
+        clipped = keep & (values >= (mean - std * low)[labels]) & (values <= (mean + std * high)[labels])
+        if np.array_equal(clipped, keep):
+            return mean
+        keep = clipped
+
+
+def azimuthal_profile(image: np.ndarray):
+    """Mean, median, std and pixel count of every one pixel wide ring around the image centre, in one pass.
+
+    NaN pixels are left out of the statistics; the circumference counts every pixel of the ring.
+    """
     size = image[0].size
-    shape = image.shape
-    radius = size // 2
-    img = image.copy()
-    profile = []
-    for r in range(0, radius):
-        mask = aperture(shape, size // 2, size // 2, r + 1)
+    radii, profiles = radial_profile(image, (size // 2, size // 2), max_radius=size // 2,
+                                     statistics=("mean", "median", "std", "pixels"))
+    return radii.astype(int), profiles["mean"], profiles["median"], profiles["std"], profiles["pixels"]
 
-        profile.append(np.nanmean(img[mask]))
 
-        img[mask] = np.nan
+def azimuthal_averaged_profile(image: np.ndarray):
+    radii, mean, _, _, _ = azimuthal_profile(image)
+    return radii, mean
 
-    return np.arange(0, radius), np.array(profile)
 
+def profile_photometrie(profiles: np.ndarray, circumference: np.ndarray, apertures, low=4.0, high=4.0):
+    """Fluxes of stacked azimuthal profiles (channel, radius) for a list of (radius, (annulus start, annulus end)).
 
-def poly_sec_ord(pos, x0, y0, axx, ayy, axy, bx, by, c):
-    return axx * (pos[:, 0] - x0) ** 2 + ayy * (pos[:, 1] - y0) ** 2 + axy * (pos[:, 0] - x0) * (
-            pos[:, 1] - y0) + bx * (pos[:, 0] - x0) + by * (pos[:, 1] - y0) + c
+    The flux inside radius is read off the cumulative sum of profile * circumference, the background is the
+    clipped median of the profile over the annulus, all annuli and channels are clipped in one batch.
+    Returns the fluxes (aperture, channel).
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    zero = np.zeros(profiles.shape[:-1] + (1,))
+    cumulative = np.concatenate((zero, np.cumsum(profiles * circumference, axis=-1)), axis=-1)
+    area = np.concatenate(([0], np.cumsum(circumference)))
 
+    radii = np.array([radius for radius, _ in apertures])
+    starts = np.array([start for _, (start, _) in apertures])
+    ends = np.maximum(np.array([end for _, (_, end) in apertures]), starts)
 
-def photometrie_poly(irad, orad, pos, image):
-    img = image.copy()[(pos[1] - orad):(pos[1] + orad),
-          (pos[0] - orad):(pos[0] + orad)].transpose()
-    mesh = np.array([[x, y] for x in range(2 * orad) for y in range(2 * orad)])
-    mask = []
-    mask_in = np.zeros_like(img, dtype=np.bool)
-    color = []
+    # ragged annuli padded to the longest one and masked
+    offsets = np.arange(np.max(ends - starts))
+    index = np.minimum(starts[:, None] + offsets, profiles.shape[-1] - 1)
+    mask = np.broadcast_to((offsets < (ends - starts)[:, None])[:, None], (len(apertures),) + profiles.shape[:-1]
+                           + offsets.shape)
+    background, _ = sigmaclip_median(np.moveaxis(profiles[..., index], -2, 0), mask, low, high)
 
-    for x in range(0, 2 * orad):
-        for y in range(0, 2 * orad):
-            if (x - orad) ** 2 + (y - orad) ** 2 <= irad ** 2:
-                mask_in[x, y] = True
-                color.append(img[x, y] * 0.75)
-            elif irad <= (x - orad) ** 2 + (y - orad) ** 2 <= orad ** 2:
-                mask.append([x, y, img[x, y]])
-                color.append(img[x, y] * 0.5)
-            else:
-                mask.append([x, y, img[x, y]])
-                color.append(img[x, y] * 0.1)
+    return cumulative[..., radii].T - area[radii][:, None] * background
+
+
+def photometrie_poly(irad, orad, pos, image, model: BackgroundSurface = None):
+    """Flux inside irad after subtracting a background surface fitted to all other pixels of the 2 orad box at pos.
 
-    mask = np.array(mask)
-    fit = curve_fit(poly_sec_ord, mask[:, :2], mask[:, 2])
+    model is a BackgroundSurface, by default the quadratic surface by plain least squares. orad can be an array
+    of box sizes, all fitted in one batch on the largest box, then the fluxes are returned as an array.
+    """
+    model = BackgroundSurface() if model is None else model
+    orads = np.atleast_1d(orad)
+    reach = int(np.max(orads))
 
-    fitted_val = poly_sec_ord(mesh, *fit[0]).reshape(img.shape)
+    # pixel coordinates relative to pos, box k holds the pixels with -orad_k <= u, v < orad_k
+    u = np.arange(-reach, reach)
+    x, y = np.meshgrid(u, u, indexing='ij')
+    values = image[pos[1] - reach:pos[1] + reach, pos[0] - reach:pos[0] + reach].T.astype(float).ravel()
+    inner = (x ** 2 + y ** 2 <= irad ** 2).ravel()
+    extent = np.maximum(-np.minimum(x, y), np.maximum(x, y) + 1).ravel()
+    outer = (extent[None] <= orads[:, None]) & ~inner
 
-    result = img - fitted_val
-    return np.sum(result[mask_in])
+    coefficients = model.fit(values, outer, reach)
+    design, _ = model.design(reach)
+    fluxes = np.sum(values[inner]) - coefficients @ np.sum(design[inner], axis=0)
+    return fluxes if np.ndim(orad) else fluxes[0]
 
 
 class OOI:
-    def __init__(self, name, pos_x, pos_y):
+    def __init__(self, name, pos_x, pos_y, flux=None):
         self.name = name
         self.pos_x = pos_x
         self.pos_y = pos_y
+        self.flux = flux
 
     def get_pos(self, text=False):
         if text:
@@ -178,6 +645,25 @@ class OOI:
         return self.pos_x, self.pos_y
 
 
+class LazyFits:
+    """Primary HDU of a FITS file, opened memory mapped only when its data is first accessed"""
+
+    def __init__(self, path):
+        self.path = path
+        self._hdul = None
+
+    @property
+    def data(self):
+        if self._hdul is None:
+            self._hdul = fits.open(self.path, memmap=True)
+        return self._hdul[0].data
+
+    def close(self):
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+
 class StarImg:
     def __init__(self, name, img_i, img_r):
         self.name: str = name
@@ -189,24 +675,117 @@ class StarImg:
         self.objects: List[OOI] = []
         self.filter_reduction = [1, 1]
 
-    def save(self):
+    def product_store(self):
+        return ProductStore(full_file_path + "/../Data/" + self.name + "_products")
+
+    def source_hashes(self, store: ProductStore = None):
+        store = store or self.product_store()
+        return [store.source_hash(img.path) if isinstance(img, LazyFits) else array_hash(img.data)
+                for img in self.images]
+
+    def provenance(self, store: ProductStore):
+        size = self.get_i_img().shape[-1]
+        return {"sources": self.source_hashes(store), "parameters": {"centre": [size // 2, size // 2]}}
+
+    def cached(self, label, parameters, compute):
+        """result of compute() as an array, reused from the product cache while data and parameters are unchanged"""
+        return get_product_cache().get(self.name + " " + label, self.source_hashes(), parameters, compute)
+
+    def photometrie(self, irad, orad, pos, displ=1, scale=1):
+        return self.cached("photometrie", [irad, orad, pos, displ, scale],
+                           lambda: photometrie_fast(irad, orad, pos, self.get_i_img(), self.get_r_img(), displ, scale))
+
+    def photometrie_exact(self, irad, orad, pos):
+        return self.cached("photometrie_exact", [irad, orad, pos],
+                           lambda: photometrie_exact(irad, orad, pos, self.get_i_img(), self.get_r_img()))
+
+    def photometrie_disk(self, hole, irad, orad, plane=None, displ=1, scale=1, bg=False):
+        """photometrie_disk around the disk on the Qphi maps (plane None) or on one Stokes plane of both bands"""
+        def compute():
+            if plane is None:
+                data_i, data_r = self.radial[0][0], self.radial[1][0]
+            else:
+                data_i, data_r = self.get_i_img()[plane], self.get_r_img()[plane]
+            return photometrie_disk(hole, irad, orad, self.disk.get_pos(), data_i, data_r, displ, scale, bg=bg)
+
+        return self.cached("photometrie_disk", [hole, irad, orad, self.disk.get_pos(), plane, displ, scale, bg],
+                           compute)
+
+    def save(self, products=PRODUCTS, compress=False):
         print("Saving ", self.name)
-        self.calc_radial_polarization()
-        for index, img in enumerate(self.images):
-            self.azimuthal.append(azimuthal_averaged_profile(img.data[0]))
-            self.azimuthal.append(azimuthal_averaged_profile(img.data[2]))
-            self.azimuthal_qphi.append(azimuthal_averaged_profile(self.radial[index][0]))
+        store = self.product_store()
+        provenance = self.provenance(store)
+
+        if "radial" in products or "azimuthal_qphi" in products:
+            self.calc_radial_polarization()
+        if "radial" in products:
+            store.write("radial", self.radial, provenance, compress)
+
+        if "azimuthal" in products:
+            self.azimuthal = []
+            for img in self.images:
+                self.azimuthal.append(azimuthal_averaged_profile(img.data[0]))
+                self.azimuthal.append(azimuthal_averaged_profile(img.data[2]))
 
-        save = [np.array(self.radial), self.azimuthal, self.azimuthal_qphi]
+            store.write("radii", self.azimuthal[0][0], provenance, compress)
+            for name, (_, profile) in zip(AZIMUTHAL_NAMES, self.azimuthal):
+                store.write("azimuthal/" + name, profile, provenance, compress)
+
+        if "azimuthal_qphi" in products:
+            self.azimuthal_qphi = [azimuthal_averaged_profile(radial[0]) for radial in self.radial]
+
+            store.write("radii", self.azimuthal_qphi[0][0], provenance, compress)
+            for name, (_, profile) in zip(BAND_NAMES, self.azimuthal_qphi):
+                store.write("azimuthal_qphi/" + name, profile, provenance, compress)
 
-        pickle.dump(save, open(full_file_path + "/../Data/" + self.name + "_save.p", "wb"))
         print("File saved")
 
-    def load(self):
-        [self.radial, self.azimuthal, self.azimuthal_qphi] = pickle.load(
-            open(full_file_path + "/../Data/" + self.name + "_save.p", "rb"))
+    def load(self, products=PRODUCTS, mmap=True):
+        store = self.product_store()
+        stale = {name.split("/")[0] for name in self.stale_products(store, products)}
+        if "radii" in stale:
+            stale.update({"azimuthal", "azimuthal_qphi"} & set(products))
+        rebuild = [product for product in products if product in stale]
+        if rebuild:
+            self.save(rebuild)
+            store = self.product_store()
+
+        for product in products:
+            get_product_cache().record(self.name + " " + product, product not in rebuild)
+
+        if "radial" in products:
+            self.radial = store.read("radial", mmap)
+
+        radii = store.read("radii", mmap) if "azimuthal" in products or "azimuthal_qphi" in products else None
+        if "azimuthal" in products:
+            self.azimuthal = [(radii, store.read("azimuthal/" + name, mmap)) for name in AZIMUTHAL_NAMES]
+        if "azimuthal_qphi" in products:
+            self.azimuthal_qphi = [(radii, store.read("azimuthal_qphi/" + name, mmap)) for name in BAND_NAMES]
+
         print(self.name, " loaded")
 
+    def load_product(self, name, mmap=True):
+        """single stored dataset, e.g. "azimuthal_qphi/i_band" for the I-band Qphi profile"""
+        return self.product_store().read(name, mmap)
+
+    def stale_products(self, store: ProductStore = None, products=PRODUCTS):
+        """stored datasets that are missing or were made from other data or parameters"""
+        store = store or self.product_store()
+        provenance = self.provenance(store)
+        names = ["radii"]
+        names += ["radial"] if "radial" in products else []
+        names += ["azimuthal/" + name for name in AZIMUTHAL_NAMES] if "azimuthal" in products else []
+        names += ["azimuthal_qphi/" + name for name in BAND_NAMES] if "azimuthal_qphi" in products else []
+        return [name for name in names if store.is_stale(name, provenance)]
+
+    @classmethod
+    def from_fits(cls, name, path_i, path_r):
+        return cls(name, LazyFits(path_i), LazyFits(path_r))
+
+    def get_plane(self, band, stokes):
+        """single Stokes plane (0..3) of the I (band 0) or R (band 1) image, only this plane is paged in"""
+        return self.images[band].data[stokes]
+
     def get_i_img(self):
         return self.images[0].data
 
@@ -217,20 +796,7 @@ class StarImg:
         self.disk = disk
 
     def calc_radial_polarization(self):
-        images_copy = self.images
-        x, y = np.meshgrid(range(0, 1024), range(0, 1024))
-        phi = angle_phi(x, y, 512, 512)
-
-        sin_2phi = np.sin(2 * phi)
-        cos_2phi = np.cos(2 * phi)
-        radial = []
-
-        for img in images_copy:
-            q_phi = -img.data[1] * cos_2phi + img.data[3] * sin_2phi
-            u_phi = img.data[1] * sin_2phi + img.data[3] * cos_2phi
-            radial.append([q_phi, u_phi])
-
-        self.radial = np.array(radial)
+        self.radial = radial_polarization(observation_stack([self])[0])
 
     def add_object(self, obj: OOI):
         self.objects.append(obj)
@@ -244,29 +810,37 @@ class StarImg:
 
         return self.objects
 
+    def detect_objects(self, sigma=2.0, threshold=5.0, min_pixels=5, max_sources=None, add=False):
+        """sources of the I band intensity, see detect_sources; with add they become objects of the image"""
+        objects = detect_sources(self.get_plane(0, 0), sigma, threshold, min_pixels, max_sources)
+        if add:
+            for obj in objects:
+                self.add_object(obj)
+        return objects
+
     def mark_disk(self, inner_radius, middle_radius, outer_radius, alpha=0.125):
 
         if self.disk is None:
             raise ValueError("Please assign a disk first")
 
-        radial_i = self.radial[0][0].copy()
-        radial_r = self.radial[1][0].copy()
+        radial_i = self.radial[0][0]
+        radial_r = self.radial[1][0]
 
         shape = radial_i.shape
         cmap = plt.cm.get_cmap('Set1_r')
 
-        mask1 = aperture(shape, *self.disk.get_pos(), middle_radius, inner_radius)
-        obj_pixel = np.sum(mask1)
+        ap1 = cutout_aperture(shape, *self.disk.get_pos(), middle_radius, inner_radius)
+        obj_pixel = ap1.count
 
-        mask2 = aperture(shape, *self.disk.get_pos(), outer_radius, middle_radius)
+        ap2 = cutout_aperture(shape, *self.disk.get_pos(), outer_radius, middle_radius)
 
-        total_counts = [np.sum(radial_i[mask1]), np.sum(radial_r[mask1])]
-        background_med = [np.median(radial_i[mask2]), np.median(radial_r[mask2])]
+        total_counts = [np.sum(ap1.values(radial_i)), np.sum(ap1.values(radial_r))]
+        background_med = [np.median(ap2.values(radial_i)), np.median(ap2.values(radial_r))]
         wo_bg_counts = [total_counts[0] - background_med[0] * obj_pixel,
                         total_counts[1] - background_med[1] * obj_pixel]
 
-        mask = 0.5 * mask1 + mask2
-        alphas = alpha * (mask1 + mask2)
+        mask = ap2.add_to(ap1.add_to(np.zeros(shape), 0.5))
+        alphas = ap2.add_to(ap1.add_to(np.zeros(shape), alpha), alpha)
 
         mask = cmap(mask)
         mask[..., -1] = alphas
@@ -274,8 +848,8 @@ class StarImg:
         return mask, np.array(total_counts), np.array(wo_bg_counts), np.array(background_med)
 
     def mark_objects(self, inner_radius, outer_radius, alpha=0.125):
-        img_i = self.images[0].data[0, :, :].copy()
-        img_r = self.images[1].data[0, :, :].copy()
+        img_i = self.images[0].data[0, :, :]
+        img_r = self.images[1].data[0, :, :]
 
         shape = img_i.shape
         cmap = plt.cm.get_cmap('Set1_r')
@@ -288,18 +862,36 @@ class StarImg:
         alphas = np.zeros(shape)
 
         for obj in self.objects:
-            mask_in = aperture(shape, *obj.get_pos(), inner_radius)
-            mask_out = aperture(shape, *obj.get_pos(), outer_radius, inner_radius)
+            ap_in = cutout_aperture(shape, *obj.get_pos(), inner_radius)
+            ap_out = cutout_aperture(shape, *obj.get_pos(), outer_radius, inner_radius)
 
-            total_counts.append([np.sum(img_i[mask_in]), np.sum(img_r[mask_in])])
-            background_avgs.append([np.median(img_i[mask_out]), np.median(img_r[mask_out])])
-            wo_bg_counts.append([total_counts[-1][0] - background_avgs[-1][0] * np.sum(mask_in),
-                                 total_counts[-1][1] - background_avgs[-1][1] * np.sum(mask_in)])
+            total_counts.append([np.sum(ap_in.values(img_i)), np.sum(ap_in.values(img_r))])
+            background_avgs.append([np.median(ap_out.values(img_i)), np.median(ap_out.values(img_r))])
+            wo_bg_counts.append([total_counts[-1][0] - background_avgs[-1][0] * ap_in.count,
+                                 total_counts[-1][1] - background_avgs[-1][1] * ap_in.count])
 
-            mask += 0.5 * mask_in + mask_out
-            alphas += alpha * (mask_in + mask_out)
+            ap_in.add_to(mask, 0.5)
+            ap_out.add_to(mask)
+            ap_in.add_to(alphas, alpha)
+            ap_out.add_to(alphas, alpha)
 
         mask = cmap(mask)
         mask[..., -1] = alphas
 
         return mask, np.array(total_counts), np.array(wo_bg_counts), np.array(background_avgs)
+
+    def mark_catalogue(self, inner_radius, outer_radius, objects=None, alpha=0.125):
+        """mark_objects for large catalogues, a pixel belongs to the aperture or annulus of its nearest object"""
+        objects = self.objects if objects is None else objects
+        images = np.array([self.images[0].data[0], self.images[1].data[0]])
+        positions = [obj.get_pos() for obj in objects]
+
+        labels, total_counts, background_avgs, counts = catalogue_photometrie(images, positions, inner_radius,
+                                                                              outer_radius)
+        wo_bg_counts = total_counts - background_avgs * counts[:, :1]
+
+        cmap = plt.cm.get_cmap('Set1_r')
+        mask = cmap(np.where(labels < 0, 0, np.where(labels % 2, 1.0, 0.5)))
+        mask[..., -1] = np.where(labels < 0, 0, alpha)
+
+        return mask, total_counts, wo_bg_counts, background_avgs
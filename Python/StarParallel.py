@@ -0,0 +1,138 @@
+import atexit
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from StarFunctions import photometrie_fast, photometrie_disk, observation_stack
+
+PhotometryJob = namedtuple("PhotometryJob", ["observation", "obj", "radii", "displ", "scale", "plane"],
+                           defaults=(1, 1, None))
+PhotometryJob.__doc__ = """Photometry of obj in observation: two radii run photometrie, three radii (hole, inner, outer)
+run photometrie_disk on the Qphi maps (plane None) or on one Stokes plane of both bands"""
+
+RESULT_DTYPE = np.dtype([("observation", "U32"), ("object", "U32"), ("radii", "i8", 3), ("displ", "i8"),
+                         ("scale", "i8"), ("plane", "i8"), ("mean", "f8", 4), ("std", "f8", 4)])
+
+_worker_store = None
+
+
+class SharedImageStore:
+    """Image stacks of StarImg observations published once in shared memory.
+
+    Worker processes open the store from its descriptors and get zero-copy read-only views by name.
+    The publishing store unlinks its blocks on close(), at the end of a with block or at shutdown.
+    """
+
+    def __init__(self, descriptors=None):
+        self.owner = descriptors is None
+        self.descriptors = dict(descriptors or {})
+        self._memories = {}
+        self._views = {}
+        if self.owner:
+            atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.descriptors
+
+    def publish(self, name, array: np.ndarray):
+        if name in self.descriptors:
+            return
+
+        array = np.asarray(array)
+        memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+        self._memories[name] = memory
+        self.descriptors[name] = (memory.name, array.shape, array.dtype.str)
+
+    def publish_observation(self, observation, radial=False):
+        """publishes "<name>/stack" (band, stokes, y, x) and with radial also "<name>/radial" """
+        if observation.name + "/stack" not in self:
+            self.publish(observation.name + "/stack", observation_stack([observation])[0])
+        if radial:
+            self.publish(observation.name + "/radial", observation.radial)
+
+    def get(self, name):
+        if name not in self._views:
+            memory_name, shape, dtype = self.descriptors[name]
+            if name not in self._memories:
+                self._memories[name] = shared_memory.SharedMemory(name=memory_name)
+            view = np.ndarray(shape, dtype, buffer=self._memories[name].buf)
+            view.setflags(write=False)
+            self._views[name] = view
+
+        return self._views[name]
+
+    def close(self):
+        self._views.clear()
+        for memory in self._memories.values():
+            try:
+                memory.close()
+            except BufferError:
+                # views handed out are still alive, the mapping goes away with the process
+                pass
+            if self.owner:
+                memory.unlink()
+
+        self._memories.clear()
+        if self.owner:
+            self.descriptors.clear()
+            atexit.unregister(self.close)
+
+
+def _init_worker(descriptors):
+    global _worker_store
+    _worker_store = SharedImageStore(descriptors)
+
+
+def _run_job(task):
+    name, pos, radii, displ, scale, plane = task
+    if len(radii) == 2:
+        stack = _worker_store.get(name + "/stack")
+        mean, std = photometrie_fast(*radii, pos, stack[0], stack[1], displ, scale)
+        return mean, std
+
+    if plane is None:
+        data = _worker_store.get(name + "/radial")[:, 0]
+    else:
+        data = _worker_store.get(name + "/stack")[:, plane]
+    mean, std = photometrie_disk(*radii, pos, data[0], data[1], displ, scale)
+    return np.pad(mean, (0, 2), constant_values=np.nan), np.pad(std, (0, 2), constant_values=np.nan)
+
+
+def run_photometry(jobs, max_workers=None, store: SharedImageStore = None):
+    """Runs the photometry jobs on a process pool and returns a structured table in the order of the jobs.
+
+    The image stacks of every observation are published once in a SharedImageStore instead of being pickled
+    per job. A store passed in is reused and left open, otherwise a temporary one is closed at the end.
+    """
+    temporary = store is None
+    store = store or SharedImageStore()
+    tasks = []
+
+    try:
+        for job in jobs:
+            store.publish_observation(job.observation, radial=len(job.radii) == 3 and job.plane is None)
+            tasks.append((job.observation.name, job.obj.get_pos(), tuple(job.radii), job.displ, job.scale, job.plane))
+
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(store.descriptors,)) as executor:
+            results = list(executor.map(_run_job, tasks))
+    finally:
+        if temporary:
+            store.close()
+
+    table = np.zeros(len(jobs), dtype=RESULT_DTYPE)
+    for row, job, (mean, std) in zip(table, jobs, results):
+        row["observation"] = job.observation.name
+        row["object"] = job.obj.name
+        row["radii"] = np.pad(job.radii, (0, 3 - len(job.radii)), constant_values=-1)
+        row["displ"], row["scale"] = job.displ, job.scale
+        row["plane"] = -1 if job.plane is None else job.plane
+        row["mean"], row["std"] = mean, std
+
+    return table
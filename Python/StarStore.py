@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+STORE_VERSION = 1
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    sha = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def array_hash(array: np.ndarray):
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha1("{}{}".format(array.dtype.str, array.shape).encode())
+    sha.update(array.data)
+    return sha.hexdigest()
+
+
+class ProductStore:
+    """Directory of named array datasets with a versioned json manifest recording their provenance.
+
+    Plain datasets are .npy files that are read memory mapped, compressed ones are .npz files.
+    Names may contain "/" to group datasets, e.g. "azimuthal_qphi/i_band".
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.manifest = {"version": STORE_VERSION, "sources": {}, "datasets": {}}
+
+        # an unreadable manifest is treated like one of another version, the store starts empty
+        try:
+            with open(self.manifest_path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = {}
+        if isinstance(manifest, dict) and manifest.get("version") == STORE_VERSION:
+            self.manifest = manifest
+
+    def __contains__(self, name):
+        return name in self.manifest["datasets"]
+
+    def names(self, group=""):
+        return [name for name in self.manifest["datasets"] if name.startswith(group)]
+
+    def write(self, name, array, provenance=None, compress=False):
+        os.makedirs(self.path, exist_ok=True)
+        file_name = name.replace("/", "__") + (".npz" if compress else ".npy")
+        array = np.asarray(array)
+
+        previous = self.manifest["datasets"].get(name)
+        if previous is not None and previous["file"] != file_name:
+            os.remove(os.path.join(self.path, previous["file"]))
+
+        if compress:
+            np.savez_compressed(os.path.join(self.path, file_name), data=array)
+        else:
+            np.save(os.path.join(self.path, file_name), array)
+
+        self.manifest["datasets"][name] = {"file": file_name, "shape": list(array.shape), "dtype": array.dtype.str,
+                                           "nbytes": array.nbytes, "provenance": provenance or {}}
+        self.flush()
+
+    def remove(self, name):
+        entry = self.manifest["datasets"].pop(name)
+        os.remove(os.path.join(self.path, entry["file"]))
+        self.flush()
+
+    def read(self, name, mmap=True):
+        entry = self.manifest["datasets"][name]
+        file_path = os.path.join(self.path, entry["file"])
+
+        if entry["file"].endswith(".npz"):
+            with np.load(file_path) as archive:
+                return archive["data"]
+
+        return np.load(file_path, mmap_mode="r" if mmap else None)
+
+    def provenance(self, name):
+        return self.manifest["datasets"][name]["provenance"]
+
+    def is_stale(self, name, provenance):
+        return name not in self or self.provenance(name) != provenance
+
+    def source_hash(self, path):
+        """hash of a source file, only re-read when its size or modification time changed"""
+        stat = os.stat(path)
+        entry = self.manifest["sources"].get(path)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha1": file_hash(path)}
+            self.manifest["sources"][path] = entry
+            self.flush()
+
+        return entry["sha1"]
+
+    def flush(self):
+        # written next to the manifest and swapped in, so a failed dump never leaves it truncated
+        os.makedirs(self.path, exist_ok=True)
+        temporary = self.manifest_path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(temporary, self.manifest_path)
+
+
+class ProductCache:
+    """Content addressed cache of derived arrays.
+
+    A product is keyed on the hashes of its input data and its parameters, computed only on a miss and
+    evicted least recently used once the cache holds more than max_bytes. report() lists what was reused.
+    """
+
+    def __init__(self, path, max_bytes=2 * 2 ** 30):
+        self.store = ProductStore(path)
+        self.max_bytes = max_bytes
+        self.log = []
+
+    @staticmethod
+    def key(label, sources, parameters):
+        description = json.dumps([label, sources, parameters], sort_keys=True, default=str)
+        return label.replace(" ", "_") + "-" + hashlib.sha1(description.encode()).hexdigest()
+
+    def get(self, label, sources, parameters, compute, mmap=True):
+        # numpy scalars and tuples are reduced to the json form the key hashes, which is also what provenance stores
+        sources = json.loads(json.dumps(sources, default=str))
+        parameters = json.loads(json.dumps(parameters, default=str))
+        key = self.key(label, sources, parameters)
+
+        if key in self.store:
+            self.record(label, True)
+            self._touch(key)
+            return self.store.read(key, mmap)
+
+        self.record(label, False)
+        value = np.asarray(compute())
+        self.store.write(key, value, {"label": label, "sources": sources, "parameters": parameters})
+        self._touch(key)
+        self.evict()
+        return value
+
+    def record(self, label, reused):
+        self.log.append((label, reused))
+
+    def evict(self):
+        datasets = self.store.manifest["datasets"]
+        size = sum(entry["nbytes"] for entry in datasets.values())
+        for key in sorted(datasets, key=lambda name: datasets[name].get("used", 0)):
+            if size <= self.max_bytes:
+                break
+            size -= datasets[key]["nbytes"]
+            self.store.remove(key)
+
+    def report(self):
+        reused = [label for label, hit in self.log if hit]
+        computed = [label for label, hit in self.log if not hit]
+        out = "Products reused: {}, computed: {}".format(len(reused), len(computed))
+        for label, hit in self.log:
+            out += "\n  {:<40} {}".format(label, "reused" if hit else "computed")
+        return out
+
+    def _touch(self, key):
+        self.store.manifest["used"] = self.store.manifest.get("used", 0) + 1
+        self.store.manifest["datasets"][key]["used"] = self.store.manifest["used"]
+        self.store.flush()
+
+
+class MaskCache:
+    """LRU cache for read-only arrays such as aperture masks, geometry maps and design matrices, bounded by a memory
+    budget in bytes"""
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, factory):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        value = factory()
+        for array in [value] if isinstance(value, np.ndarray) else vars(value).values():
+            if isinstance(array, np.ndarray):
+                array.setflags(write=False)
+
+        if value.nbytes <= self.max_bytes:
+            self._entries[key] = value
+            self.nbytes += value.nbytes
+            self._evict()
+
+        return value
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.nbytes}
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, value = self._entries.popitem(last=False)
+            self.nbytes -= value.nbytes
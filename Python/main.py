@@ -1,22 +1,13 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import curve_fit
 from scipy.stats import sigmaclip
-from StarData import cyc116, ND4, PointSpread, cyc116_second_star, cyc116_ghost2, ND4_filter_data, HD100453_fluxes, \
-    Rband_filter, Iband_filter
+from StarData import HD100453_fluxes, Rband_filter, Iband_filter
 from datetime import datetime
-from scipy.ndimage import gaussian_filter1d
 import StarGUI
 import DiskGUI
-from StarFunctions import aperture, magnitude_wavelength_plot, photometrie_poly, photometrie, photometrie_disk
-
-
-def scaling_func(pos, a, b):
-    return a * (pos - b)
-
-
-def scaling_gauss_func(pos, a, b, sig):
-    return a * (gaussian_filter1d(pos, sig) - b)
+from StarFunctions import azimuthal_profile, magnitude_wavelength_plot, photometrie_poly, profile_photometrie, \
+    get_product_cache
+from StarFit import fit_profiles, sweep_fits
 
 
 def mkdir_p(mypath):
@@ -106,7 +97,7 @@ def aperture_photometrie():
     results_big = []
     for observation in [cyc116, ND4, PointSpread]:
         print(observation.name)
-        result = photometrie(416, 466, (512, 512), observation.get_i_img(), observation.get_r_img())
+        result = observation.photometrie(416, 466, (512, 512))
         results_big.append(result)
         print(result)
         print(result[1] / result[0])
@@ -155,40 +146,16 @@ def aperture_photometrie():
 
     print("Mixed profile")
 
-    data_iq = mixed_profiles[0] * circumference
-    data_iu = mixed_profiles[1] * circumference
-    data_rq = mixed_profiles[2] * circumference
-    data_ru = mixed_profiles[3] * circumference
-    res_iq = []
-    res_iu = []
-    res_rq = []
-    res_ru = []
-    res_small_iq = []
-    res_small_iu = []
-    res_small_rq = []
-    res_small_ru = []
-    for rad_displ in np.arange(-1, 2):
-        res_iq.append(np.sum(data_iq[:(416 + rad_displ)]) - np.sum(circumference[:(416 + rad_displ)]) *
-                      np.median(sigmaclip(mixed_profiles[0][(416 + rad_displ):467])[0]))
-        res_iu.append(np.sum(data_iu[:(416 + rad_displ)]) - np.sum(circumference[:(416 + rad_displ)]) *
-                      np.median(sigmaclip(mixed_profiles[1][(416 + rad_displ):467])[0]))
-        res_rq.append(np.sum(data_rq[:(416 + rad_displ)]) - np.sum(circumference[:(416 + rad_displ)]) *
-                      np.median(sigmaclip(mixed_profiles[2][(416 + rad_displ):467])[0]))
-        res_ru.append(np.sum(data_ru[:(416 + rad_displ)]) - np.sum(circumference[:(416 + rad_displ)]) *
-                      np.median(sigmaclip(mixed_profiles[3][(416 + rad_displ):467])[0]))
-
-        res_small_iq.append(np.sum(data_iq[:(20 + rad_displ)]) - np.sum(circumference[:(20 + rad_displ)]) *
-                            np.median(sigmaclip(mixed_profiles[0][(20 + rad_displ):40])[0]))
-        res_small_iu.append(np.sum(data_iu[:(20 + rad_displ)]) - np.sum(circumference[:(20 + rad_displ)]) *
-                            np.median(sigmaclip(mixed_profiles[1][(20 + rad_displ):40])[0]))
-        res_small_rq.append(np.sum(data_rq[:(20 + rad_displ)]) - np.sum(circumference[:(20 + rad_displ)]) *
-                            np.median(sigmaclip(mixed_profiles[2][(20 + rad_displ):40])[0]))
-        res_small_ru.append(np.sum(data_ru[:(20 + rad_displ)]) - np.sum(circumference[:(20 + rad_displ)]) *
-                            np.median(sigmaclip(mixed_profiles[3][(20 + rad_displ):40])[0]))
-
-    print([np.mean(res_iq), np.mean(res_rq)], [np.std(res_iq) / np.mean(res_iq), np.std(res_rq) / np.mean(res_rq)])
-    print([np.mean(res_iu), np.mean(res_ru)], [np.std(res_iu) / np.mean(res_iu), np.std(res_ru) / np.mean(res_ru)])
-    results_big_mixed = np.array([np.mean(res_iq), np.mean(res_iu), np.mean(res_rq), np.mean(res_ru)])
+    # channels I-Q, I-U, R-Q, R-U; big and small aperture, each with the radius wiggled by one
+    rad_displ = np.arange(-1, 2)
+    apertures = [(416 + displ, (416 + displ, 467)) for displ in rad_displ] + \
+                [(20 + displ, (20 + displ, 40)) for displ in rad_displ]
+    fluxes = profile_photometrie(np.array(mixed_profiles), circumference, apertures)
+    res_big, res_small = fluxes[:len(rad_displ)], fluxes[len(rad_displ):]
+
+    results_big_mixed = np.mean(res_big, axis=0)
+    print(results_big_mixed[[0, 2]], np.std(res_big, axis=0)[[0, 2]] / results_big_mixed[[0, 2]])
+    print(results_big_mixed[[1, 3]], np.std(res_big, axis=0)[[1, 3]] / results_big_mixed[[1, 3]])
     print()
 
     magnitude_wavelength_plot(HD100453_fluxes, (Rband_filter, Iband_filter))
@@ -200,7 +167,7 @@ def aperture_photometrie():
     print("cyc116")
     print()
     for obj in cyc116.get_objects():
-        results_small_cyc.append(photometrie(20, 39, obj.get_pos(), cyc116.get_i_img(), cyc116.get_r_img()))
+        results_small_cyc.append(cyc116.photometrie(20, 39, obj.get_pos()))
         print(obj.name)
         print(results_small_cyc[-1])
         print(results_small_cyc[-1][1] / results_small_cyc[-1][0])
@@ -209,7 +176,7 @@ def aperture_photometrie():
     print("ND4")
     print()
     for obj in ND4.get_objects():
-        results_small_nd4.append(photometrie(20, 39, obj.get_pos(), ND4.get_i_img(), ND4.get_r_img()))
+        results_small_nd4.append(ND4.photometrie(20, 39, obj.get_pos()))
         print(obj.name)
         print(results_small_nd4[-1])
         print(results_small_nd4[-1][1] / results_small_nd4[-1][0])
@@ -218,7 +185,7 @@ def aperture_photometrie():
     print("PSF")
     print()
     for obj in PointSpread.get_objects():
-        results_small_psf.append(photometrie(20, 39, obj.get_pos(), PointSpread.get_i_img(), PointSpread.get_r_img()))
+        results_small_psf.append(PointSpread.photometrie(20, 39, obj.get_pos()))
         print(obj.name)
         print(results_small_psf[-1])
         print(results_small_psf[-1][1] / results_small_psf[-1][0])
@@ -226,12 +193,8 @@ def aperture_photometrie():
 
     print("Mixed")
     print()
-    print([np.mean(res_small_iq), np.mean(res_small_iu), np.mean(res_small_rq), np.mean(res_small_ru)],
-          [np.std(res_small_iq) / np.mean(res_small_iq), np.std(res_small_iu) / np.mean(res_small_iu),
-           np.std(res_small_rq) / np.mean(res_small_rq), np.std(res_small_ru) / np.mean(res_small_ru)])
-
-    results_small_mixed = np.array([np.mean(res_small_iq), np.mean(res_small_iu), np.mean(res_small_rq),
-                                    np.mean(res_small_ru)])
+    results_small_mixed = np.mean(res_small, axis=0)
+    print(results_small_mixed, np.std(res_small, axis=0) / results_small_mixed)
     print()
 
     # print("Scaled")
@@ -249,21 +212,19 @@ def aperture_photometrie():
 
     print("Disk")
     print()
-    results_disk = photometrie_disk(28, 93, 124, cyc116.disk.get_pos(), cyc116.radial[0][0], cyc116.radial[1][0])
+    results_disk = cyc116.photometrie_disk(28, 93, 124)
     print(results_disk)
     print(results_disk[1] / results_disk[0])
     print()
 
     print("Q frame")
-    results_u = photometrie_disk(28, 93, 124, cyc116.disk.get_pos(), cyc116.get_i_img()[1], cyc116.get_r_img()[1],
-                                 bg=True)
+    results_u = cyc116.photometrie_disk(28, 93, 124, plane=1, bg=True)
     print(results_u)
     print(results_u[1] / results_u[0])
     print()
 
     print("U frame")
-    results_u = photometrie_disk(28, 93, 124, cyc116.disk.get_pos(), cyc116.get_i_img()[3], cyc116.get_r_img()[3],
-                                 bg=True)
+    results_u = cyc116.photometrie_disk(28, 93, 124, plane=3, bg=True)
     print(results_u)
     print(results_u[1] / results_u[0])
     print()
@@ -271,16 +232,11 @@ def aperture_photometrie():
     print("----- 3d Background -----")
     radius_range = np.arange(-3, 4)
 
-    results_3d_sec = []
-    results_3d_g2 = []
-    for inner_range in radius_range:
-        results_3d_sec.append(photometrie_poly(20, 39 + inner_range, cyc116_second_star.get_pos(),
-                                               cyc116.get_i_img()[0]))
-        results_3d_g2.append(photometrie_poly(20, 39 + inner_range, cyc116_ghost2.get_pos(), cyc116.get_i_img()[0]))
+    results_3d_sec = photometrie_poly(20, 39 + radius_range, cyc116_second_star.get_pos(), cyc116.get_i_img()[0])
+    results_3d_g2 = photometrie_poly(20, 39 + radius_range, cyc116_ghost2.get_pos(), cyc116.get_i_img()[0])
 
-    results_sec = photometrie(20, 39, cyc116_second_star.get_pos(), cyc116.get_i_img(), cyc116.get_r_img(), displ=0,
-                              scale=3)
-    results_g2 = photometrie(20, 39, cyc116_ghost2.get_pos(), cyc116.get_i_img(), cyc116.get_r_img(), displ=0, scale=3)
+    results_sec = cyc116.photometrie(20, 39, cyc116_second_star.get_pos(), displ=0, scale=3)
+    results_g2 = cyc116.photometrie(20, 39, cyc116_ghost2.get_pos(), displ=0, scale=3)
 
     print("Companion")
     print(np.mean(results_3d_sec), np.std(results_3d_sec))
@@ -318,236 +274,232 @@ def aperture_photometrie():
     # print()
 
 
-""" GUI """
-
-# DiskGUI.start(cyc116)
-#
-# StarGUI.start(cyc116)
-#
-# StarGUI.start(ND4)
-
-""" Plots """
-
-# annulus_plot()
-#
-filter_plot()
-#
-# overview_plot()
-#
-# disk_plot()
-
-""" Fits """
-print("--------- Fitting ---------")
-start_int = 14
-end_int = 65
-start_peak = 0
-end_peak = 32
-transition = 21
-y_min = 0.1
-tail = np.linspace(120, 200, 8, dtype=int, endpoint=False)
-
-nd4_region = np.arange(start_int, end_int)
-psf_region = np.concatenate((np.arange(start_peak, end_peak), tail))
-
-markers_on_nd4 = [start_int, end_int]
-markers_on_psf = [end_peak, *tail]
-weights_nd4 = np.concatenate((np.full((21 - start_int,), 1), np.full((end_int - 21,), 1)))
-weights_psf = np.concatenate((np.full((end_peak - start_peak,), 15), np.full_like(tail, 1)))
-bounds_psf = ([0, -np.inf, 0], np.inf)
-
-save = True
-smart = False
-
-results = []
-scal_profiles = []
-mixed_profiles = []
-star_profiles = []
-
-circumference = [np.sum(aperture((1024, 1024), 512, 512, r, r - 1)) for r in range(1, 513)]
-profile = ["I-band", "I-band $I_U$", "R-band", "R-band $I_U$"]
-
-if save:
-    folder = datetime.now().strftime('%d_%m_%H%M')
-    path = "../Bilder/" + folder
-    mkdir_p(path)
-
-    param_file = open(path + "/parameters.txt", "w")
-
-for index, _ in enumerate(profile):
-    print(profile[index])
-    radi, cyc116_profile = cyc116.azimuthal[index]
-    _, nd4_profile = ND4.azimuthal[index]
-
-    _, psf_profile = PointSpread.azimuthal[index]
-
-    x2, qphi = cyc116.azimuthal_qphi[index // 2]
-
-    guess = (1.0 / ND4.filter_reduction[index // 2], np.median(nd4_profile[100:]))
-    print("guess: ", guess)
-
-    scaling_factor = curve_fit(scaling_func, nd4_profile[nd4_region], cyc116_profile[nd4_region], p0=guess,
-                               sigma=weights_nd4)
-    print("scaling factor", scaling_factor)
-
-    scaled_profile = scaling_func(nd4_profile, *scaling_factor[0])
-    scal_profiles.append(scaled_profile)
-
-    mixed_profile = cyc116_profile.copy()
-    mixed_profile[:transition] = scaled_profile[:transition]
-    mixed_profiles.append(mixed_profile)
-
-    if smart:
-        tail = np.array((np.abs(scaled_profile[120:200] - cyc116_profile[120:200]) <= 0.6827).nonzero()) \
-               + 120
-        print("Points satisfy condition: ", len(tail[0]))
-        tail = tail[0, ::-len(tail[0]) // 8]
-        tail = tail[::-1]
-        psf_region = np.concatenate((np.arange(end_peak), tail))
-        weights_psf = np.concatenate((np.full((end_peak,), 4.50), np.full_like(tail, 1)))
+if __name__ == "__main__":
+    # loading the observations and the analysis only run in the script, not in sweep workers importing it
+    from StarData import cyc116, ND4, PointSpread, cyc116_second_star, cyc116_ghost2, ND4_filter_data
+
+    """ GUI """
+
+    # DiskGUI.start(cyc116)
+    #
+    # StarGUI.start(cyc116)
+    #
+    # StarGUI.start(ND4)
+
+    """ Plots """
+
+    # annulus_plot()
+    #
+    filter_plot()
+    #
+    # overview_plot()
+    #
+    # disk_plot()
+
+    """ Fits """
+    print("--------- Fitting ---------")
+    start_int = 14
+    end_int = 65
+    start_peak = 0
+    end_peak = 32
+    transition = 21
+    y_min = 0.1
+    tail = np.linspace(120, 200, 8, dtype=int, endpoint=False)
+
+    markers_on_nd4 = [start_int, end_int]
+
+    save = True
+    smart = False
+    sweep = False
+
+    results = []
+
+    _, _, _, _, circumference = azimuthal_profile(cyc116.radial[0][0])
+    profile = ["I-band", "I-band $I_U$", "R-band", "R-band $I_U$"]
+
+    if save:
+        folder = datetime.now().strftime('%d_%m_%H%M')
+        path = "../Bilder/" + folder
+        mkdir_p(path)
+
+        param_file = open(path + "/parameters.txt", "w")
+
+    cyc116_profiles = np.array([cyc116.azimuthal[index][1] for index, _ in enumerate(profile)])
+    nd4_profiles = np.array([ND4.azimuthal[index][1] for index, _ in enumerate(profile)])
+    psf_profiles = np.array([PointSpread.azimuthal[index][1] for index, _ in enumerate(profile)])
+    qphi_profiles = np.array([cyc116.azimuthal_qphi[index // 2][1] for index, _ in enumerate(profile)])
+
+    fits = fit_profiles(cyc116_profiles, nd4_profiles, psf_profiles, qphi_profiles, circumference, start_int, end_int,
+                        start_peak, end_peak, transition, tail, smart)
+    nd4_region, weights_nd4 = fits["nd4_region"], fits["nd4_weights"]
+    scal_profiles, mixed_profiles, star_profiles = list(fits["scaled"]), list(fits["mixed"]), list(fits["star"])
+
+    if sweep:
+        sweep_grid = {"start_int": [10, 14, 18], "end_int": [55, 65, 75], "end_peak": [28, 32, 36],
+                      "transition": [17, 21, 25], "tail": [tail, np.linspace(100, 220, 12, dtype=int, endpoint=False)],
+                      "smart": [False, True]}
+        sweep_table = sweep_fits(cyc116_profiles, nd4_profiles, psf_profiles, qphi_profiles, circumference, sweep_grid)
+        if save:
+            np.save(path + "/sweep.npy", sweep_table)
+        for band, _ in enumerate(profile):
+            rows = sweep_table[sweep_table["band"] == band]
+            print(profile[band], "disk counts over the sweep:", np.nanmean(rows["disk"][:, 0]),
+                  np.nanstd(rows["disk"][:, 0]))
+        print()
+
+    for index, _ in enumerate(profile):
+        print(profile[index])
+        radi, cyc116_profile = cyc116.azimuthal[index]
+        x2, qphi = cyc116.azimuthal_qphi[index // 2]
+
+        scaling_factor = fits["scaling"][0][index], fits["scaling"][1][index]
+        print("scaling factor", scaling_factor)
+
+        if smart:
+            print("Points satisfy condition: ", np.sum(np.abs(fits["scaled"][index][120:200] -
+                                                                cyc116_profile[120:200]) <= 0.6827))
+        tail = fits["tails"][index]
+        psf_region, weights_psf = fits["psf_regions"][index], fits["psf_weights"][index]
         markers_on_psf = [end_peak, *tail]
 
-    psf_factor = curve_fit(scaling_gauss_func, psf_profile[psf_region], mixed_profile[psf_region],
-                           sigma=weights_psf, bounds=bounds_psf)
-    print("psf factor", psf_factor)
+        psf_factor = fits["psf"][index]
+        print("psf factor", psf_factor)
+
+        mixed_profile = mixed_profiles[index]
+        star_profile = star_profiles[index]
+        disk_profile = mixed_profile - star_profile
+
+        fig_comp = plt.figure(figsize=(14, 7), num="Profiles " + profile[index])
+        textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig_comp)
+        textax.axis('off')
+        textax.text(0, 0, profile[index], fontsize=18, ha='center')
+
+        ax = fig_comp.add_subplot(1, 1, 1)
+        ax.tick_params(labelsize=18)
+        ax.plot(radi, cyc116_profile, '-', label="profile of cyc116", markevery=markers_on_nd4)
+        ax.plot(radi, mixed_profile, '-', label="mixed profile", markevery=list(tail))
+        nd4_equation = R"$({:.2})\cdot(ND4-({:.2}))$".format(*scaling_factor[0])
+        ax.plot([], [], ' ', label=nd4_equation)
+        ax.plot(radi, star_profile, '-C2', label="star profile", markevery=markers_on_psf)
+        psf_equation = R"$({:.2})\cdot(gauss(PSF,{:.2})-({:.2}))$".format(*psf_factor[0])
+        ax.plot([], [], ' ', label=psf_equation)
+        ax.legend(fontsize='large', framealpha=1, loc=4)
+        ax.set_yscale('log', nonposy='clip')
+        ax.set_ylim(ymin=y_min)
+
+        zoom_xax = (0, 60)
+
+        axins = ax.inset_axes([0.35, 0.55, 0.5, 0.43])
+        axins.semilogy(radi, cyc116_profile, '-', label="profile of cyc116", markevery=markers_on_nd4)
+        axins.semilogy(radi, mixed_profile, '-', label="mixed profile", markevery=list(tail))
+        axins.semilogy(radi, star_profile, '-', label="Star profile", markevery=markers_on_psf)
+        axins.set_ylim(
+            (0.9 * np.min(star_profile[zoom_xax[0]:zoom_xax[1]]), 1.5 * np.max(star_profile[zoom_xax[0]:zoom_xax[1]])))
+        axins.set_xlim((-3, 60))
+        ax.indicate_inset_zoom(axins)
+
+        fig_sub = plt.figure(figsize=(16, 7), num="Disk " + profile[index])
+        textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig_sub)
+        textax.axis('off')
+        textax.text(0, 0, "Subtraction in " + profile[index], fontsize=18, ha='center')
+
+        ax = fig_sub.add_subplot(1, 1, 1)
+        ax.tick_params(labelsize=18)
+        line1, = ax.plot(radi, disk_profile, label="Reduced cyc116 profile")
+        ax.set_xlim(xmin=-3.5, xmax=130)
+        ax1 = ax.twinx()
+        ax1.tick_params(labelsize=18)
+        line2, = ax1.plot(x2[20:], qphi[20:], "C3", label="Qphi profile")
+        ax.tick_params(axis='y', labelcolor="C0")
+        ax1.tick_params(axis='y', labelcolor="C3")
+        ax1.set_ylim(ymin=-40, ymax=1.1 * max(qphi[20:120]))
+        ax.set_ylim(ymin=-500, ymax=1.1 * max(disk_profile[20:120]))
+        line3 = ax.axhline(0, ls='--', c='k', alpha=0.5, label="zero")
+        lines = [line1, line2, line3]
+        align_yaxis(ax, 0, ax1, 0)
+        ax.fill_between([32, 118], [-3000, -3000], [1000, 1000], alpha=0.2, color="gold")
+        ax.legend(lines, [line.get_label() for line in lines], fontsize='x-large', framealpha=1, loc=1)
+
+        if save:
+            fig_comp.savefig(path + "/Profiles_" + profile[index] + ".png", dpi=150, bbox_inches='tight',
+                             pad_inches=0.1)
+            fig_sub.savefig(path + "/Subtraction_" + profile[index] + ".png", dpi=150, bbox_inches='tight',
+                            pad_inches=0.1)
+
+            param_file.write("\n" + profile[index] + "\n")
+            param_file.write("Smart: {}\n".format(smart))
+            param_file.write("ND4:\n")
+            param_file.write("Region: {}\n".format(nd4_region))
+            param_file.write("Weights: {}\n".format(weights_nd4))
+
+            param_file.write("PSF:\n")
+            param_file.write("Region: {}\n".format(psf_region))
+            param_file.write("Weights: {}\n".format(weights_psf))
+            param_file.write("\nScaling factor: {}\n".format(scaling_factor[0]))
+            param_file.write(("PSF factor: {}\n".format(psf_factor[0])))
+
+        print("Counts fit: ", *fits["counts"][index, 0])
+        print("Qphi counts: ", *fits["counts"][index, 1])
+        print()
 
-    star_profile = scaling_gauss_func(psf_profile, *psf_factor[0])
-    star_profiles.append(star_profile)
+    print(fits["fit"].report())
+    print()
 
-    disk_profile = mixed_profile - star_profile
+    if save:
+        print("File saved")
+        print()
+        param_file.close()
 
-    fig_comp = plt.figure(figsize=(14, 7), num="Profiles " + profile[index])
-    textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig_comp)
-    textax.axis('off')
-    textax.text(0, 0, profile[index], fontsize=18, ha='center')
+    """ comparison """
+    print("--------- comparison ---------")
+    print()
+    cutoff = 80
 
-    ax = fig_comp.add_subplot(1, 1, 1)
-    ax.tick_params(labelsize=18)
-    ax.plot(radi, cyc116_profile, '-', label="profile of cyc116", markevery=markers_on_nd4)
-    ax.plot(radi, mixed_profile, '-', label="mixed profile", markevery=list(tail))
-    nd4_equation = R"$({:.2})\cdot(ND4-({:.2}))$".format(*scaling_factor[0])
-    ax.plot([], [], ' ', label=nd4_equation)
-    ax.plot(radi, star_profile, '-C2', label="star profile", markevery=markers_on_psf)
-    psf_equation = R"$({:.2})\cdot(gauss(PSF,{:.2})-({:.2}))$".format(*psf_factor[0])
-    ax.plot([], [], ' ', label=psf_equation)
-    ax.legend(fontsize='large', framealpha=1, loc=4)
-    ax.set_yscale('log', nonposy='clip')
-    ax.set_ylim(ymin=y_min)
-
-    zoom_xax = (0, 60)
-
-    axins = ax.inset_axes([0.35, 0.55, 0.5, 0.43])
-    axins.semilogy(radi, cyc116_profile, '-', label="profile of cyc116", markevery=markers_on_nd4)
-    axins.semilogy(radi, mixed_profile, '-', label="mixed profile", markevery=list(tail))
-    axins.semilogy(radi, star_profile, '-', label="Star profile", markevery=markers_on_psf)
-    axins.set_ylim(
-        (0.9 * np.min(star_profile[zoom_xax[0]:zoom_xax[1]]), 1.5 * np.max(star_profile[zoom_xax[0]:zoom_xax[1]])))
-    axins.set_xlim((-3, 60))
-    ax.indicate_inset_zoom(axins)
-
-    fig_sub = plt.figure(figsize=(16, 7), num="Disk " + profile[index])
-    textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig_sub)
+    _, cyc116_i = np.array(cyc116.azimuthal[0])
+    _, cyc116_r = np.array(cyc116.azimuthal[1])
+
+    comp_nd4_i = cyc116_i / scal_profiles[0]
+    comp_nd4_r = cyc116_r / scal_profiles[1]
+
+    comp_psf_i = scal_profiles[0] / star_profiles[0]
+    comp_psf_r = scal_profiles[1] / star_profiles[1]
+
+    fig = plt.figure(figsize=(14, 6))
+    textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig)
     textax.axis('off')
-    textax.text(0, 0, "Subtraction in " + profile[index], fontsize=18, ha='center')
+    textax.text(0, 0, "Comparison", fontsize=18, ha='center')
+    ax = fig.add_subplot(1, 1, 1)
+    ax.tick_params(labelsize=18)
+    ax.locator_params(axis='y', nbins=8)
+    ax.plot(np.arange(cutoff), comp_nd4_i[:cutoff], label="nd4_i")
+    ax.plot(np.arange(cutoff), comp_nd4_r[:cutoff], label="nd4_r")
+    ax.axhline(0.9, ls='--', c='k', alpha=0.125, zorder=-1)
+    ax.axhline(1.1, ls='--', c='k', alpha=0.125, zorder=-1)
+    ax.fill_between([start_int, end_int], [0.9, 0.9], [1.1, 1.1], alpha=0.2, color="gold")
+    ax.legend()
+    if save:
+        fig.savefig(path + "/Comparison.png", dpi=150, bbox_inches='tight', pad_inches=0.1)
 
-    ax = fig_sub.add_subplot(1, 1, 1)
+    fig = plt.figure(figsize=(14, 6))
+    textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig)
+    textax.axis('off')
+    textax.text(0, 0, "Comparison", fontsize=18, ha='center')
+    ax = fig.add_subplot(1, 1, 1)
     ax.tick_params(labelsize=18)
-    line1, = ax.plot(radi, disk_profile, label="Reduced cyc116 profile")
-    ax.set_xlim(xmin=-3.5, xmax=130)
-    ax1 = ax.twinx()
-    ax1.tick_params(labelsize=18)
-    line2, = ax1.plot(x2[20:], qphi[20:], "C3", label="Qphi profile")
-    ax.tick_params(axis='y', labelcolor="C0")
-    ax1.tick_params(axis='y', labelcolor="C3")
-    ax1.set_ylim(ymin=-40, ymax=1.1 * max(qphi[20:120]))
-    ax.set_ylim(ymin=-500, ymax=1.1 * max(disk_profile[20:120]))
-    line3 = ax.axhline(0, ls='--', c='k', alpha=0.5, label="zero")
-    lines = [line1, line2, line3]
-    align_yaxis(ax, 0, ax1, 0)
-    ax.fill_between([32, 118], [-3000, -3000], [1000, 1000], alpha=0.2, color="gold")
-    ax.legend(lines, [line.get_label() for line in lines], fontsize='x-large', framealpha=1, loc=1)
+    ax.locator_params(axis='y', nbins=8)
+    ax.plot(np.arange(cutoff), comp_psf_i[:cutoff], label="nd4_i")
+    ax.plot(np.arange(cutoff), comp_psf_r[:cutoff], label="nd4_r")
+    ax.axhline(0.9, ls='--', c='k', alpha=0.125, zorder=-1)
+    ax.axhline(1.1, ls='--', c='k', alpha=0.125, zorder=-1)
+    ax.fill_between([start_peak, end_peak], [0.9, 0.9], [1.1, 1.1], alpha=0.2, color="gold")
 
     if save:
-        fig_comp.savefig(path + "/Profiles_" + profile[index] + ".png", dpi=150, bbox_inches='tight', pad_inches=0.1)
-        fig_sub.savefig(path + "/Subtraction_" + profile[index] + ".png", dpi=150, bbox_inches='tight', pad_inches=0.1)
-
-        param_file.write("\n" + profile[index] + "\n")
-        param_file.write("Smart: {}\n".format(smart))
-        param_file.write("ND4:\n")
-        param_file.write("Region: {}\n".format(nd4_region))
-        param_file.write("Weights: {}\n".format(weights_nd4))
-
-        param_file.write("PSF:\n")
-        param_file.write("Region: {}\n".format(psf_region))
-        param_file.write("Weights: {}\n".format(weights_psf))
-        param_file.write("\nScaling factor: {}\n".format(scaling_factor[0]))
-        param_file.write(("PSF factor: {}\n".format(psf_factor[0])))
-
-    disk_profile[disk_profile < 0] = 0
-    count_disk = []
-    count_qphi = []
-    int_range = np.arange(-2, 3)
-    for inner_wiggle in int_range:
-        for outer_wiggle in int_range:
-            count_disk.append(np.sum((disk_profile * circumference)[(32 + inner_wiggle):(118 + outer_wiggle)]))
-            count_qphi.append(np.sum((qphi * circumference)[(32 + inner_wiggle):(118 + outer_wiggle)]))
-
-    print("Counts fit: ", np.mean(count_disk), np.std(count_disk))
-    print("Qphi counts: ", np.mean(count_qphi), np.std(count_qphi))
-    print()
+        fig.savefig(path + "/Comparison2.png", dpi=150, bbox_inches='tight', pad_inches=0.1)
 
-if save:
-    print("File saved")
-    print()
-    param_file.close()
-
-""" comparison """
-print("--------- comparison ---------")
-print()
-cutoff = 80
-
-_, cyc116_i = np.array(cyc116.azimuthal[0])
-_, cyc116_r = np.array(cyc116.azimuthal[1])
-
-comp_nd4_i = cyc116_i / scal_profiles[0]
-comp_nd4_r = cyc116_r / scal_profiles[1]
-
-comp_psf_i = scal_profiles[0] / star_profiles[0]
-comp_psf_r = scal_profiles[1] / star_profiles[1]
-
-fig = plt.figure(figsize=(14, 6))
-textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig)
-textax.axis('off')
-textax.text(0, 0, "Comparison", fontsize=18, ha='center')
-ax = fig.add_subplot(1, 1, 1)
-ax.tick_params(labelsize=18)
-ax.locator_params(axis='y', nbins=8)
-ax.plot(np.arange(cutoff), comp_nd4_i[:cutoff], label="nd4_i")
-ax.plot(np.arange(cutoff), comp_nd4_r[:cutoff], label="nd4_r")
-ax.axhline(0.9, ls='--', c='k', alpha=0.125, zorder=-1)
-ax.axhline(1.1, ls='--', c='k', alpha=0.125, zorder=-1)
-ax.fill_between([start_int, end_int], [0.9, 0.9], [1.1, 1.1], alpha=0.2, color="gold")
-ax.legend()
-if save:
-    fig.savefig(path + "/Comparison.png", dpi=150, bbox_inches='tight', pad_inches=0.1)
-
-fig = plt.figure(figsize=(14, 6))
-textax = plt.axes([0.5, 0.9, 0.3, 0.03], figure=fig)
-textax.axis('off')
-textax.text(0, 0, "Comparison", fontsize=18, ha='center')
-ax = fig.add_subplot(1, 1, 1)
-ax.tick_params(labelsize=18)
-ax.locator_params(axis='y', nbins=8)
-ax.plot(np.arange(cutoff), comp_psf_i[:cutoff], label="nd4_i")
-ax.plot(np.arange(cutoff), comp_psf_r[:cutoff], label="nd4_r")
-ax.axhline(0.9, ls='--', c='k', alpha=0.125, zorder=-1)
-ax.axhline(1.1, ls='--', c='k', alpha=0.125, zorder=-1)
-ax.fill_between([start_peak, end_peak], [0.9, 0.9], [1.1, 1.1], alpha=0.2, color="gold")
-
-if save:
-    fig.savefig(path + "/Comparison2.png", dpi=150, bbox_inches='tight', pad_inches=0.1)
-
-""" Aperture photometrie """
-
-aperture_photometrie()
-
-plt.show()
+    """ Aperture photometrie """
+
+    aperture_photometrie()
+
+    print(get_product_cache().report())
+
+    plt.show()